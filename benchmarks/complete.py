@@ -0,0 +1,87 @@
+"""
+Latency benchmark for `bibsearch complete`.
+
+Builds a database of synthetic entries (100k by default) in a temporary
+directory and measures how long completing keys and title words takes.
+Fails if the 99th percentile is over budget.
+
+    python benchmarks/complete.py [--entries N] [--budget MS]
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from bibsearch.bibdb import BibDB
+from bibsearch.config import Config
+
+
+def make_word(rng):
+    syllables = [rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(rng.randint(2, 4))]
+    return "".join(syllables)
+
+
+def make_rows(n, rng):
+    surnames = [make_word(rng) for _ in range(n // 20 + 1)]
+    vocabulary = [make_word(rng) for _ in range(20000)]
+    for i in range(n):
+        surname = rng.choice(surnames)
+        year = rng.randint(1990, 2019)
+        # Skewed towards the beginning of the vocabulary, like real titles
+        title = " ".join(vocabulary[int(rng.paretovariate(1.2)) % len(vocabulary)] for _ in range(rng.randint(3, 10)))
+        key = "E%d" % i
+        author = "%s %s and %s" % (rng.choice(string.ascii_uppercase), surname.capitalize(), make_word(rng).capitalize())
+        key_fields = dict(surname=surname, et_al="_etAl", year=year, short_year=year % 100, title=title.split()[0])
+        fields = json.dumps({"type": "article", "fields": {"title": title, "year": str(year)}, "persons": {}})
+        fulltext = '@article{%s,\n    title = "%s",\n    year = "%d"\n}\n' % (key, title, year)
+        yield key, key_fields, author, title, "Synthetic Proceedings", str(year), fields, fulltext
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100000, help="Number of entries (default: %(default)s)")
+    parser.add_argument("--queries", type=int, default=500, help="Number of completions to time (default: %(default)s)")
+    parser.add_argument("--budget", type=float, default=10, help="Maximum 99th percentile latency in ms (default: %(default)s)")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as bibsearch_dir:
+        config = Config(os.path.join(bibsearch_dir, "config"))
+        config.bibsearch_dir = bibsearch_dir
+        db = BibDB(config)
+        start = time.perf_counter()
+        with db.bulk_import():
+            for row in make_rows(args.entries, rng):
+                db.add_prepared(row)
+        db.save()
+        print("Built a database of {} entries in {:.1f}s".format(len(db), time.perf_counter() - start))
+
+        db.cursor.execute("SELECT custom_key, title FROM bib ORDER BY random() LIMIT ?", [args.queries])
+        samples = db.cursor.fetchall()
+        partials = []
+        for custom_key, title in samples:
+            partials.append(custom_key[:rng.randint(1, 6)])
+            words = title.split()[:rng.randint(1, 3)]
+            words[-1] = words[-1][:rng.randint(1, len(words[-1]))]
+            partials.append(" ".join(words))
+
+        timings = []
+        for partial in partials:
+            start = time.perf_counter()
+            db.complete(partial)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        median = timings[len(timings) // 2]
+        p99 = timings[int(len(timings) * 0.99)]
+        print("{} completions: median {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms (budget: {:.0f} ms)".format(
+            len(timings), median, p99, timings[-1], args.budget))
+        sys.exit(0 if p99 <= args.budget else 1)
+
+
+if __name__ == "__main__":
+    main()
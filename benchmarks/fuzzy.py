@@ -0,0 +1,101 @@
+"""
+Latency and recall benchmark for `bibsearch find --fuzzy`.
+
+Builds a database of synthetic entries (200k by default) in a temporary
+directory, like benchmarks/complete.py, and measures fuzzy searches for
+the misspelled author name and title words of an entry. Fails if the 99th
+percentile is over budget, or if too few searches find the entry in their
+first results (among those where the correctly spelled search does). The
+synthetic words get denser as the database grows, so that misspellings are
+more often ambiguous and the recall lower than with real titles. The time
+for building the trigram index is reported apart.
+
+    python benchmarks/fuzzy.py [--entries N] [--budget MS] [--recall R]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bibsearch.bibdb import BibDB
+from bibsearch.config import Config
+
+from complete import make_rows
+
+
+def misspell(word, rng):
+    position = rng.randrange(len(word))
+    edit = rng.choice(["delete", "replace", "insert"])
+    if edit == "delete":
+        return word[:position] + word[position + 1:]
+    letter = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    if edit == "replace":
+        return word[:position] + letter + word[position + 1:]
+    return word[:position] + letter + word[position:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=200000, help="Number of entries (default: %(default)s)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of searches to time (default: %(default)s)")
+    parser.add_argument("--budget", type=float, default=100, help="Maximum 99th percentile latency in ms (default: %(default)s)")
+    parser.add_argument("--recall", type=float, default=0.6,
+                        help="Minimum fraction of searches finding their entry (default: %(default)s)")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as bibsearch_dir:
+        config = Config(os.path.join(bibsearch_dir, "config"))
+        config.bibsearch_dir = bibsearch_dir
+        db = BibDB(config)
+        start = time.perf_counter()
+        with db.bulk_import():
+            for row in make_rows(args.entries, rng):
+                db.add_prepared(row)
+        db.save()
+        print("Built a database of {} entries in {:.1f}s".format(len(db), time.perf_counter() - start))
+
+        start = time.perf_counter()
+        db._update_fuzzy_index()
+        print("Built the trigram index in {:.1f}s".format(time.perf_counter() - start))
+
+        # All three words are misspelled. Short words are avoided, as one
+        # edit often turns them into another indexed word.
+        queries = []
+        for rowid in rng.sample(range(1, len(db) + 1), len(db)):
+            db.cursor.execute("SELECT key, author, title FROM bib WHERE rowid = ?", [rowid])
+            key, author, title = db.cursor.fetchone()
+            surname = author.split()[1].lower()
+            long_words = sorted(set(word for word in title.split() if len(word) >= 6))
+            if len(surname) >= 6 and len(long_words) >= 2:
+                words = ["author:" + surname] + rng.sample(long_words, 2)
+                queries.append((key, words, ["author:" + misspell(surname, rng)] + [misspell(word, rng) for word in words[1:]]))
+                if len(queries) == args.queries:
+                    break
+
+        timings = []
+        found, findable = 0, 0
+        for key, words, query in queries:
+            start = time.perf_counter()
+            results = db.search(query, limit=10, fuzzy=True)
+            timings.append((time.perf_counter() - start) * 1000)
+            # Common words may match too many entries even when spelled right
+            if key in [entry.key for entry in db.search(words, limit=10)]:
+                findable += 1
+                found += key in [entry.key for entry in results]
+        timings.sort()
+        median = timings[len(timings) // 2]
+        p99 = timings[int(len(timings) * 0.99)]
+        print("{} searches: median {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms (budget: {:.0f} ms)".format(
+            len(timings), median, p99, timings[-1], args.budget))
+        recall = found / max(findable, 1)
+        print("Found the entry in the first 10 results for {:.0%} of the {} searches where possible (minimum: {:.0%})".format(
+            recall, findable, args.recall))
+        sys.exit(0 if p99 <= args.budget and recall >= args.recall else 1)
+
+
+if __name__ == "__main__":
+    main()
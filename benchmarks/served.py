@@ -0,0 +1,68 @@
+"""
+Latency benchmark for commands answered by `bibsearch serve`.
+
+Starts a server on an empty database in a temporary directory, and times a
+`find` passed on to it by the bibsearch entry point, against the same
+command run directly and against the start-up of a bare interpreter. Fails
+if the served command takes more than the budget on top of the interpreter
+start-up.
+
+    python benchmarks/served.py [--runs N] [--budget MS]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def median_time(command, runs, env):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="Number of runs of each command (default: %(default)s)")
+    parser.add_argument("--budget", type=float, default=40,
+                        help="Maximum median latency over the interpreter start-up in ms (default: %(default)s)")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    with tempfile.TemporaryDirectory() as bibsearch_dir:
+        config_file = os.path.join(bibsearch_dir, "config")
+        with open(config_file, "w") as f:
+            f.write("[bibsearch]\nbibsearch_dir = %s\n" % bibsearch_dir)
+        find = ["-c", config_file, "find", "translation"]
+        server = subprocess.Popen([sys.executable, "-c", "from bibsearch.client import main; main()",
+                                   "-c", config_file, "serve"], env=env, stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(os.path.join(bibsearch_dir, "bibsearch.sock")):
+                if server.poll() is not None:
+                    sys.exit("The server did not start")
+                time.sleep(0.05)
+            bare = median_time([sys.executable, "-c", "pass"], args.runs, env)
+            served = median_time([sys.executable, "-c", "from bibsearch.client import main; main()"] + find,
+                                 args.runs, env)
+            direct = median_time([sys.executable, "-c", "from bibsearch.bibsearch import main; main()"] + find,
+                                 args.runs, env)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print("Interpreter start-up: {:.1f} ms".format(bare))
+    print("Served find: {:.1f} ms".format(served))
+    print("Direct find: {:.1f} ms".format(direct))
+    print("Served latency over start-up: {:.1f} ms (budget: {:.0f} ms)".format(served - bare, args.budget))
+    sys.exit(0 if served - bare <= args.budget else 1)
+
+
+if __name__ == "__main__":
+    main()
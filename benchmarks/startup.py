@@ -0,0 +1,65 @@
+"""
+Start-up benchmark for the bibsearch command line.
+
+Measures the time needed for importing bibsearch with `python -X importtime`,
+excluding the interpreter's own start-up, and fails if it is over budget or
+if any of the slow dependencies are imported eagerly.
+
+    python benchmarks/startup.py [--budget MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# These must only be imported by the commands needing them
+DEFERRED_MODULES = ["pybtex", "yaml", "tqdm", "urllib.request", "pkg_resources", "stop_words", "feedparser"]
+
+
+def import_times(module):
+    """Returns a dict from module name to cumulative import time in microseconds."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                             env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=100, help="Maximum import time in ms (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the fastest one is reported")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+    args = parser.parse_args()
+
+    # Make sure that bytecode is cached before measuring
+    import_times("bibsearch.bibsearch")
+    runs = [import_times("bibsearch.bibsearch") for _ in range(args.repeat)]
+    times = min(runs, key=lambda t: t["bibsearch.bibsearch"])
+    total = times["bibsearch.bibsearch"] / 1000
+
+    print("Importing bibsearch: {:.1f} ms (budget: {:.0f} ms)".format(total, args.budget))
+    print("Slowest imports:")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print("  {:8.1f} ms  {}".format(cumulative / 1000, name))
+
+    failed = False
+    eager = [name for name in DEFERRED_MODULES if name in times]
+    if eager:
+        print("Imported at start-up, but should be deferred:", ", ".join(eager))
+        failed = True
+    if total > args.budget:
+        print("Over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Micro-benchmark for bibutils.tex_to_unicode.
+
+Converts the author, title and venue strings of a BibTeX file (e.g. a
+dump of the ACL Anthology), as done when importing and displaying
+entries: with the converter from before the single-pass rewrite, then
+with the current one without the cache and with it. Without a file, only
+a long author list full of accents is converted.
+
+    python benchmarks/tex_to_unicode.py [anthology.bib.gz]
+"""
+
+import argparse
+import gzip
+import time
+
+from bibsearch import bibutils
+
+
+class BaselineTeXProcessor(bibutils.TeXProcessor):
+    """
+    TeXProcessor as it was before the single-pass rewrite, which rebuilds
+    the string on every macro expansion.
+    """
+
+    def process(self, string):
+        self.__data = string
+        self.__off = 0
+
+        # Process macros
+        while True:
+            m = bibutils.tex_cs_re.search(self.__data, self.__off)
+            if not m:
+                break
+            self.__off = m.end()
+            macro = m.group(1)
+            nval = self._expand(macro)
+            if nval is None:
+                continue
+            self.__data = self.__data[:m.start()] + nval + \
+                          self.__data[self.__off:]
+            self.__off = m.start() + len(nval)
+
+        return self.__data
+
+    def _scan_argument(self):
+        if self.__off >= len(self.__data):
+            raise ValueError('macro argument expected')
+        if self.__data[self.__off] == '{':
+            start = self.__off
+            depth = 0
+            while depth or self.__off == start:
+                if self.__data[self.__off] == '{':
+                    depth += 1
+                elif self.__data[self.__off] == '}':
+                    depth -= 1
+                self.__off += 1
+            return self.__data[start + 1:self.__off - 1]
+        elif self.__data[self.__off] == '\\':
+            m = bibutils.tex_cs_re.match(self.__data, self.__off)
+            self.__off = m.end()
+            return m.group(1)
+        else:
+            arg = self.__data[self.__off]
+            self.__off += 1
+            return arg
+
+
+class BaselineTeXToUnicode(bibutils.TeXToUnicode, BaselineTeXProcessor):
+    pass
+
+
+def baseline_tex_to_unicode(string):
+    # A new converter for every string, and no fast path
+    return BaselineTeXToUnicode().process(string)
+
+
+def load_strings(fname):
+    opener = gzip.open if fname.endswith(".gz") else open
+    strings = []
+    with opener(fname, "rt", encoding="utf-8") as stream:
+        for entry in bibutils.iter_bibtex_entries(stream):
+            if "author" in entry.persons:
+                strings.append(", ".join(bibutils.get_author_name(a) for a in entry.persons["author"]))
+            for field in ("title", "booktitle", "journal"):
+                if field in entry.fields:
+                    strings.append(entry.fields[field])
+    return strings
+
+
+def timed(function, strings, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for string in strings:
+            try:
+                function(string)
+            except ValueError:
+                pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", help="BibTeX file, optionally gzipped")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the strings")
+    args = parser.parse_args()
+
+    strings = load_strings(args.file) if args.file else []
+    # A long author list full of accents, the worst case for rebuilding the string on every macro
+    strings.append(" and ".join(["M{\\'e}lanie M{\\\"u}ller-{\\v{S}}imi{\\'c}"] * 500))
+    print("{} strings, {:.1f} MB".format(len(strings), sum(len(s) for s in strings) / 1e6))
+
+    convert = bibutils.tex_to_unicode
+    uncached = convert.__wrapped__
+    # The rewrite must not change the results
+    for string in strings:
+        try:
+            expected = baseline_tex_to_unicode(string)
+        except ValueError:
+            continue
+        assert uncached(string) == expected, string[:100]
+
+    baseline = timed(baseline_tex_to_unicode, strings, args.repeat)
+    print("baseline: {:.3f}s".format(baseline))
+    single_pass = timed(uncached, strings, args.repeat)
+    print("uncached: {:.3f}s ({:.1f}x faster)".format(single_pass, baseline / single_pass))
+    convert.cache_clear()
+    cached = timed(convert, strings, args.repeat)
+    print("cached:   {:.3f}s ({:.1f}x faster)".format(cached, baseline / cached))
+
+
+if __name__ == "__main__":
+    main()
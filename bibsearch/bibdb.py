@@ -1,21 +1,133 @@
-import functools
+import collections
+import contextlib
+import heapq
+import json
 import logging
 import os.path
-import pybtex.database as pybtex
+import re
 import sqlite3
 import sys
-import yaml
 
-from typing import Tuple
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pybtex.database as pybtex
 
 from . import bibutils
 
+# Columns of the FTS index, in order. The fulltext is stored, but not indexed.
+_FTS_COLUMNS = ["key", "custom_key", "author", "title", "venue", "year", "abstract", "keywords", "fulltext"]
+
+def _fts_insert_trigger(columns: List[str]) -> str:
+    """
+    Returns the trigger keeping the FTS index in sync on insertion. It is kept
+    separately from the other triggers because bulk imports drop it and
+    index the new rows at the end.
+    """
+    return """CREATE TRIGGER bib_ai AFTER INSERT ON bib BEGIN
+               INSERT INTO bibindex
+                   (rowid, {columns})
+                   VALUES
+                   (new.rowid, {new});
+                END;""".format(columns=", ".join(columns),
+                               new=", ".join("new." + c for c in columns))
+
+def _fts_delete_trigger(columns: List[str]) -> str:
+    return """CREATE TRIGGER bib_ad AFTER DELETE ON bib BEGIN
+               INSERT INTO bibindex
+                   (bibindex, rowid, {columns})
+                   VALUES
+                   ('delete', old.rowid, {old});
+                END;""".format(columns=", ".join(columns),
+                               old=", ".join("old." + c for c in columns))
+
+def _fts_update_trigger(columns: List[str]) -> str:
+    # Only changes in the indexed columns need to be propagated to the FTS index
+    return """CREATE TRIGGER bibindex_au AFTER UPDATE OF
+                   {columns} ON bib BEGIN
+               INSERT INTO bibindex
+                   (bibindex, rowid, {columns})
+                   VALUES
+                   ('delete', old.rowid, {old});
+               INSERT INTO bibindex
+                   (rowid, {columns})
+                   VALUES
+                   (new.rowid, {new});
+                END;""".format(columns=", ".join(columns),
+                               old=", ".join("old." + c for c in columns),
+                               new=", ".join("new." + c for c in columns))
+
+# Columns looked up in the postings table, which replaces the FTS index if
+# it is not available. The table refers to them by their position here.
+_POSTINGS_COLUMNS = ["key", "custom_key", "author", "title", "venue", "year", "abstract", "keywords"]
+
+def _row_postings(rows: List[tuple], columns: List[str]) -> List[tuple]:
+    """
+    Returns the postings of (rowid, column values...) rows, as (term,
+    column, rowid) tuples.
+    """
+    positions = [_POSTINGS_COLUMNS.index(column) for column in columns]
+    postings = []
+    for row in rows:
+        for column, text in zip(positions, row[1:]):
+            postings.extend((term, column, row[0]) for term in set(bibutils.index_tokens(text)))
+    return postings
+
+# A search term in a macro, possibly a quoted phrase with a column specifier
+_query_term_re = re.compile(r'(?:\w+:)?"[^"]*"|\S+')
+
+# Columns storing the folded text of the searchable columns, which is
+# matched by phrase searches without FTS
+_FOLDED_COLUMNS = collections.OrderedDict([("author", "folded_author"),
+                                           ("title", "folded_title"),
+                                           ("venue", "folded_venue")])
+
+# Columns selected for building BibEntry objects
+_ENTRY_COLUMNS = "bib.rowid, bib.key, bib.custom_key, bib.author, bib.title, bib.venue, bib.year, bib.fields, bib.fulltext"
+
+class BibEntry(collections.namedtuple("BibEntry",
+                                      "rowid key custom_key author title venue year fields fulltext")):
+    """
+    An entry as stored in the database. author, title and venue are already
+    converted to unicode, and fields holds the type, fields and persons of
+    the entry as a dict (see bibutils.entry_to_json). rowid is None for
+    entries that are not stored in the database.
+    """
+
+    @classmethod
+    def from_row(cls, row):
+        fields = json.loads(row[7]) if row[7] else {"fields": {}, "persons": {}}
+        return cls._make(row[:7] + (fields, row[8]))
+
+    @classmethod
+    def from_pybtex(cls, entry: "pybtex.Entry", key: str = None):
+        """
+        Builds an entry that is not stored in the database.
+
+        :param entry: The pybtex entry.
+        :param key: The original key. Defaults to the key of the entry.
+        """
+        utf_author, utf_title, utf_venue = bibutils.display_fields(entry)
+        return cls(None,
+                   key or entry.key,
+                   entry.key,
+                   utf_author,
+                   utf_title,
+                   utf_venue,
+                   str(entry.fields.get("year")),
+                   json.loads(bibutils.entry_to_json(entry)),
+                   bibutils.single_entry_to_fulltext(entry))
+
+    @property
+    def display_key(self):
+        return self.custom_key or self.key
+
 class BibDB:
     def __init__(self, config):
         self.config = config
         self.fname = os.path.join(self.config.bibsearch_dir, "bib.db")
 
-        self.column_names_no_key = ["author", "title", "venue", "year"]
+        self.column_names_no_key = ["author", "title", "venue", "year", "abstract", "keywords"]
 
         createDB = False
         if not os.path.exists(self.fname):
@@ -24,11 +136,21 @@ class BibDB:
             createDB = True
         self.connection = sqlite3.connect(self.fname)
         self.cursor = self.connection.cursor()
+        # Only set while inside a bulk_import() block
+        self._bulk_rows = None
+        self._bulk_files = None
+        self._bulk_keys = None
+        self._bulk_custom_keys = None
+        self._bulk_suffix_levels = None
         if createDB:
             self._create_db()
         # Find out if we have FTS
-        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bibindex'")
-        self.has_fts = bool(self.cursor.fetchone())
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('bibindex', 'fuzzy_terms')")
+        schema_names = set(row[0] for row in self.cursor)
+        self.has_fts = "bibindex" in schema_names
+        # The trigram index for fuzzy searches is built on first use
+        self.has_fuzzy_index = "fuzzy_terms" in schema_names
+        self._upgrade_db()
 
     def _create_db(self):
         self.cursor.execute("""CREATE TABLE bib (
@@ -55,13 +177,7 @@ class BibDB:
                 fulltext UNINDEXED,
                 content='bib',
                 );
-            CREATE TRIGGER bib_ai AFTER INSERT ON bib BEGIN
-               INSERT INTO bibindex
-                   (rowid, key, custom_key, author, title, venue, year, fulltext)
-                   VALUES 
-                   (new.rowid, new.key, new.custom_key, new.author, new.title, 
-                   new.venue, new.year, new.fulltext);
-                END;
+            """ + _fts_insert_trigger(["key", "custom_key", "author", "title", "venue", "year", "fulltext"]) + """
             CREATE TRIGGER bib_ad AFTER DELETE ON bib BEGIN
                INSERT INTO bibindex
                    (bibindex, rowid, key, custom_key, author, title, venue, year, fulltext)
@@ -86,31 +202,413 @@ class BibDB:
             error_msg = str(e)
             if "no such module" in error_msg and "fts5" in error_msg:
                 logging.warning("It seems your sqlite3 installation does not support fts5 indexing.")
-                logging.warning("It is strongly encouraged to activate fts5 (see the README and the FAQ).")
-                input("Press ENTER to continue...")
+                logging.warning("Searches will use a simpler index, activating fts5 is encouraged (see the README and the FAQ).")
             else:
                 raise
 
+    # Schema changes, applied in order to bring databases created by older
+    # versions up to date (new databases are also created through them). The
+    # number of upgrades applied is stored in sqlite's user_version. Each
+    # upgrade is committed together with the new version, so it must not
+    # commit by itself (e.g. with executescript).
+    _UPGRADES = ["_upgrade_download_validators",
+                 "_upgrade_structured_fields",
+                 "_upgrade_rendered_cache",
+                 "_upgrade_search_cache",
+                 "_upgrade_fts_prefix_index",
+                 "_upgrade_fts_diacritics",
+                 "_upgrade_folded_columns",
+                 "_upgrade_postings",
+                 "_upgrade_pdfs",
+                 "_upgrade_body_index",
+                 "_upgrade_long_fields",
+                ]
+
+    def _upgrade_db(self):
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+        for version, upgrade in enumerate(self._UPGRADES[version:], version + 1):
+            # An interrupted upgrade is rolled back, and retried on the next run
+            if not self.connection.in_transaction:
+                self.cursor.execute("BEGIN")
+            try:
+                getattr(self, upgrade)()
+                self.cursor.execute("PRAGMA user_version = %d" % version)
+            except BaseException:
+                self.connection.rollback()
+                raise
+            self.save()
+        # Upgrades changing the FTS index leave it empty, it is filled once
+        # they have all run (or on the next run, if this is interrupted)
+        if self.has_fts and self.get_stat("fts_rebuild_pending"):
+            self.cursor.execute("INSERT INTO bibindex(bibindex) VALUES ('rebuild')")
+            self.cursor.execute("DELETE FROM stats WHERE name = 'fts_rebuild_pending'")
+            self.save()
+
+    def _upgrade_download_validators(self):
+        """Stores the HTTP validators and checksum of downloaded files."""
+        for column in ["etag text", "last_modified text", "size integer", "sha256 text"]:
+            self.cursor.execute("ALTER TABLE downloaded_files ADD COLUMN %s" % column)
+
+    def _upgrade_structured_fields(self):
+        """Stores the fields of each entry as JSON, computed from the fulltext."""
+        if self.has_fts:
+            # The new column is not indexed, changes to it should not reach
+            # the FTS index
+            self.cursor.execute("DROP TRIGGER bibindex_au")
+            self.cursor.execute(_fts_update_trigger(["key", "custom_key", "author", "title", "venue", "year", "fulltext"]))
+        self.cursor.execute("ALTER TABLE bib ADD COLUMN fields text")
+        last_rowid = 0
+        while True:
+            self.cursor.execute("SELECT rowid, fulltext FROM bib WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                                [last_rowid])
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, fulltext in rows:
+                try:
+                    updates.append((bibutils.entry_to_json(bibutils.fulltext_to_single_entry(fulltext)), rowid))
+                except Exception:
+                    logging.warning("Could not parse entry %d of the database", rowid)
+            self.cursor.executemany("UPDATE bib SET fields=? WHERE rowid=?", updates)
+            last_rowid = rows[-1][0]
+
+    def _upgrade_rendered_cache(self):
+        """Caches the rendered form of entries, see get_rendered."""
+        # Statement by statement, executescript would commit the upgrade
+        self.cursor.execute("""CREATE TABLE rendered (
+            entry integer,
+            format text,
+            original_key integer,
+            text text,
+            PRIMARY KEY (entry, format, original_key)
+            ) WITHOUT ROWID""")
+        self.cursor.execute("""CREATE TRIGGER rendered_ad AFTER DELETE ON bib BEGIN
+            DELETE FROM rendered WHERE entry = old.rowid;
+            END""")
+        self.cursor.execute("""CREATE TRIGGER rendered_au AFTER UPDATE ON bib BEGIN
+            DELETE FROM rendered WHERE entry = old.rowid;
+            END""")
+        self.cursor.execute("""CREATE TABLE stats (
+            name text PRIMARY KEY,
+            value integer
+            )""")
+
+    def _upgrade_search_cache(self):
+        """Moves the search cache from lastSearch.yml to the database."""
+        self.cursor.execute("""CREATE TABLE search_cache (
+            position integer PRIMARY KEY,
+            entry integer,
+            key text,
+            fulltext text
+            )""")
+        last_results_fname = os.path.join(self.config.bibsearch_dir, "lastSearch.yml")
+        if os.path.exists(last_results_fname):
+            os.remove(last_results_fname)
+
+    def _rebuild_fts(self, columns: List[str], options: str):
+        """
+        Recreates the FTS index and its triggers, e.g. for changing its
+        options. The entries are indexed again at the end of _upgrade_db, so
+        that several upgrades recreating the index only fill it once.
+
+        :param columns: The columns of the index. The fulltext is not indexed.
+        :param options: Additional FTS5 options.
+        """
+        if not self.has_fts:
+            return
+        for trigger in ["bib_ai", "bib_ad", "bibindex_au"]:
+            self.cursor.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+        self.cursor.execute("DROP TABLE bibindex")
+        self.cursor.execute("CREATE VIRTUAL TABLE bibindex USING fts5(%s, content='bib', %s)"
+                            % (", ".join(c + " UNINDEXED" if c == "fulltext" else c for c in columns),
+                               options))
+        self.cursor.execute(_fts_insert_trigger(columns))
+        self.cursor.execute(_fts_delete_trigger(columns))
+        self.cursor.execute(_fts_update_trigger(columns))
+        self.cursor.execute("INSERT OR REPLACE INTO stats(name, value) VALUES ('fts_rebuild_pending', 1)")
+
+    def _upgrade_fts_prefix_index(self):
+        """Adds prefix indexes to the FTS index, for completion."""
+        self._rebuild_fts(["key", "custom_key", "author", "title", "venue", "year", "fulltext"],
+                          "prefix='2 3'")
+
+    def _upgrade_fts_diacritics(self):
+        """
+        Makes the FTS index ignore all diacritics, including those of letters
+        with several of them (e.g. "ễ").
+        """
+        # Older versions only support remove_diacritics 1, the default
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            self._rebuild_fts(["key", "custom_key", "author", "title", "venue", "year", "fulltext"],
+                              "prefix='2 3', tokenize='unicode61 remove_diacritics 2'")
+
+    def _upgrade_folded_columns(self):
+        """
+        Stores the author, title and venue lowercased and without diacritics
+        (see bibutils.fold), for searching without FTS.
+        """
+        for column in _FOLDED_COLUMNS.values():
+            self.cursor.execute("ALTER TABLE bib ADD COLUMN %s text" % column)
+        last_rowid = 0
+        while True:
+            self.cursor.execute("SELECT rowid, author, title, venue FROM bib WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                                [last_rowid])
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            self.cursor.executemany("UPDATE bib SET folded_author=?, folded_title=?, folded_venue=? WHERE rowid=?",
+                                    [(bibutils.fold(author), bibutils.fold(title), bibutils.fold(venue), rowid)
+                                     for rowid, author, title, venue in rows])
+            last_rowid = rows[-1][0]
+
+    def _upgrade_postings(self):
+        """Indexes the words of each entry if FTS is not available."""
+        if self.has_fts:
+            return
+        self.cursor.execute("""CREATE TABLE postings (
+            term text,
+            entry integer,
+            col integer,
+            PRIMARY KEY (term, entry, col)
+            ) WITHOUT ROWID""")
+        columns = ["key", "custom_key", "author", "title", "venue", "year"]
+        last_rowid = 0
+        while True:
+            self.cursor.execute("SELECT rowid, %s FROM bib WHERE rowid > ? ORDER BY rowid LIMIT 1000"
+                                % ", ".join(columns), [last_rowid])
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            self.cursor.executemany("INSERT OR IGNORE INTO postings(term, col, entry) VALUES (?,?,?)",
+                                    _row_postings(rows, columns))
+            last_rowid = rows[-1][0]
+
+    def _upgrade_pdfs(self):
+        """
+        Keeps track of downloaded PDFs. Files are stored by their checksum,
+        see bibsearch.store_pdf, and the row of a removed entry is kept
+        without entry until `gc` deletes its file.
+        """
+        self.cursor.execute("""CREATE TABLE pdfs (
+            entry integer UNIQUE,
+            path text UNIQUE,
+            size integer,
+            sha256 text,
+            mtime real
+            )""")
+        self.cursor.execute("CREATE INDEX pdfs_sha256 ON pdfs(sha256)")
+        self.cursor.execute("""CREATE TRIGGER pdfs_ad AFTER DELETE ON bib BEGIN
+            UPDATE pdfs SET entry = NULL WHERE entry = old.rowid;
+            END""")
+
+    def _upgrade_body_index(self):
+        """
+        Indexes the text of downloaded PDFs, see store_body. The checksum of
+        the indexed file is kept so that only new or changed PDFs are
+        processed again.
+        """
+        self.cursor.execute("ALTER TABLE pdfs ADD COLUMN indexed_sha256 text")
+        if not self.has_fts:
+            return
+        tokenize = ", tokenize='unicode61 remove_diacritics 2'" if sqlite3.sqlite_version_info >= (3, 27, 0) else ""
+        self.cursor.execute("CREATE VIRTUAL TABLE bodyindex USING fts5(body%s)" % tokenize)
+        self.cursor.execute("""CREATE TRIGGER bodyindex_ad AFTER DELETE ON bib BEGIN
+            DELETE FROM bodyindex WHERE rowid = old.rowid;
+            END""")
+
+    def _upgrade_long_fields(self):
+        """
+        Stores the abstract and keywords of entries in their own columns,
+        computed from the fields, and indexes them.
+        """
+        for column in ["abstract", "keywords"]:
+            self.cursor.execute("ALTER TABLE bib ADD COLUMN %s text" % column)
+        last_rowid = 0
+        while True:
+            self.cursor.execute("SELECT rowid, fields FROM bib WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                                [last_rowid])
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            updates = [bibutils.long_fields(fields) + (rowid,) for rowid, fields in rows]
+            updates = [update for update in updates if update[:2] != (None, None)]
+            self.cursor.executemany("UPDATE bib SET abstract=?, keywords=? WHERE rowid=?", updates)
+            if not self.has_fts:
+                self.cursor.executemany("INSERT OR IGNORE INTO postings(term, col, entry) VALUES (?,?,?)",
+                                        _row_postings([(rowid, abstract, keywords)
+                                                       for abstract, keywords, rowid in updates],
+                                                      ["abstract", "keywords"]))
+            last_rowid = rows[-1][0]
+        if self.has_fts:
+            options = "prefix='2 3'"
+            if sqlite3.sqlite_version_info >= (3, 27, 0):
+                options += ", tokenize='unicode61 remove_diacritics 2'"
+            self._rebuild_fts(["key", "custom_key", "author", "title", "venue", "year", "abstract", "keywords",
+                               "fulltext"], options)
+
+    def _postings(self, where_clause: str, parameters: list) -> List[tuple]:
+        """
+        Returns the postings of the entries selected by a WHERE clause, as
+        (term, column, rowid) tuples.
+        """
+        self.cursor.execute("SELECT rowid, %s FROM bib WHERE %s" % (", ".join(_POSTINGS_COLUMNS), where_clause),
+                            parameters)
+        return _row_postings(self.cursor.fetchall(), _POSTINGS_COLUMNS)
+
+    def _index_postings(self, where_clause: str, parameters: list):
+        """Adds the entries selected by a WHERE clause to the postings table."""
+        if not self.has_fts:
+            self.cursor.executemany("INSERT OR IGNORE INTO postings(term, col, entry) VALUES (?,?,?)",
+                                    self._postings(where_clause, parameters))
+
+    def _unindex_postings(self, where_clause: str, parameters: list):
+        """
+        Removes the entries selected by a WHERE clause from the postings
+        table, before they are modified or deleted.
+        """
+        if not self.has_fts:
+            self.cursor.executemany("DELETE FROM postings WHERE term = ? AND col = ? AND entry = ?",
+                                    self._postings(where_clause, parameters))
+
     def __len__(self):
         self.cursor.execute('SELECT COUNT(*) FROM bib')
         return int(self.cursor.fetchone()[0])
 
-    def save_to_search_cache(self, search: Tuple[str,str,str]) -> None:
+    def get_rendered(self, rowids: List[int], output_format: str, original_key: bool) -> dict:
+        """
+        Looks up cached renderings of entries, see format_search_results.
+
+        :param rowids: The rowids of the entries.
+        :param output_format: The output format, including any variant.
+        :param original_key: Whether the rendering uses the original key.
+        :return: A dict from rowid to rendered text, for the cached entries.
+        """
+        rendered = {}
+        for chunk_start in range(0, len(rowids), 500):
+            chunk = rowids[chunk_start:chunk_start + 500]
+            self.cursor.execute("""SELECT entry, text FROM rendered
+                                   WHERE format = ? AND original_key = ? AND entry IN (%s)""" % ",".join("?" * len(chunk)),
+                                [output_format, int(original_key)] + chunk)
+            rendered.update(self.cursor)
+        return rendered
+
+    def store_rendered(self, renderings: List[tuple]) -> None:
+        """
+        Stores renderings of entries as (rowid, format, original key, text)
+        tuples. They are dropped when the entry is updated or removed.
+        """
+        self.cursor.executemany("INSERT OR REPLACE INTO rendered(entry, format, original_key, text) VALUES (?,?,?,?)",
+                                [(rowid, output_format, int(original_key), text)
+                                 for rowid, output_format, original_key, text in renderings])
+
+    def get_pdfs(self, rowids: List[int]) -> dict:
+        """
+        Returns the downloaded PDFs of entries, as a dict from rowid to a
+        (path, size, sha256, mtime) tuple.
+        """
+        pdfs = {}
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            self.cursor.execute("SELECT entry, path, size, sha256, mtime FROM pdfs WHERE entry IN (%s)"
+                                % ",".join("?" * len(chunk)), chunk)
+            pdfs.update((row[0], row[1:]) for row in self.cursor)
+        return pdfs
+
+    def store_pdfs(self, pdfs: List[tuple]) -> None:
+        """
+        Records downloaded PDFs as (rowid, path, size, sha256, mtime) tuples,
+        replacing any previous PDF of the entries.
+        """
+        self.cursor.executemany("INSERT OR REPLACE INTO pdfs(entry, path, size, sha256, mtime) VALUES (?,?,?,?,?)",
+                                pdfs)
+
+    def pdfs_to_index(self) -> List[tuple]:
+        """
+        Returns the PDFs of all entries as (rowid, path, size, sha256, mtime,
+        indexed sha256) tuples, the latter being None if the text of the
+        entry has not been indexed.
         """
-        Saves the result of a search, which is represented as a tuple: (full bibtex, collection, key).
+        self.cursor.execute("SELECT entry, path, size, sha256, mtime, indexed_sha256 FROM pdfs WHERE entry IS NOT NULL")
+        return self.cursor.fetchall()
+
+    def store_body(self, rowid: int, sha256: str, text: str) -> None:
+        """Indexes the text extracted from the PDF of an entry, for body searches."""
+        self.cursor.execute("DELETE FROM bodyindex WHERE rowid = ?", [rowid])
+        self.cursor.execute("INSERT INTO bodyindex(rowid, body) VALUES (?,?)", [rowid, text])
+        self.cursor.execute("UPDATE pdfs SET indexed_sha256 = ? WHERE entry = ?", [sha256, rowid])
+
+    def orphaned_pdfs(self) -> List[tuple]:
+        """Returns the path and sha256 of the PDFs whose entry has been removed."""
+        self.cursor.execute("SELECT path, sha256 FROM pdfs WHERE entry IS NULL")
+        return self.cursor.fetchall()
+
+    def remove_pdfs(self, paths: List[str]) -> None:
+        self.cursor.executemany("DELETE FROM pdfs WHERE path = ?", [(path,) for path in paths])
+
+    def pdf_checksums(self) -> set:
+        """Returns the checksums of the PDFs still in use."""
+        self.cursor.execute("SELECT DISTINCT sha256 FROM pdfs")
+        return set(row[0] for row in self.cursor)
+
+    def increment_stat(self, name: str, value: int = 1) -> None:
+        self.cursor.execute("UPDATE stats SET value = value + ? WHERE name = ?", [value, name])
+        if self.cursor.rowcount == 0:
+            self.cursor.execute("INSERT INTO stats(name, value) VALUES (?,?)", [name, value])
+
+    def get_stat(self, name: str) -> int:
+        self.cursor.execute("SELECT value FROM stats WHERE name = ?", [name])
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def save_to_search_cache(self, search: List[BibEntry]) -> None:
+        """
+        Saves the result of a search. Entries in the database are stored by
+        rowid and key, others (e.g. from the arXiv) with their key and full
+        BibTeX.
         This can then be used by subcommands that support implicit arguments, like 'open'.
         """
-        last_results_fname = os.path.join(self.config.bibsearch_dir, "lastSearch.yml")
-        with open(last_results_fname, "w") as fp:
-            yaml.dump(search, fp)
+        self.cursor.execute("DELETE FROM search_cache")
+        self.cursor.executemany("INSERT INTO search_cache(position, entry, key, fulltext) VALUES (?,?,?,?)",
+                                [(position, entry.rowid, entry.key, None) if entry.rowid is not None
+                                 else (position, None, entry.key, entry.fulltext)
+                                 for position, entry in enumerate(search, 1)])
+        self.save()
 
-    def load_search_cache(self) -> Tuple[str,str,str]:
+    def get_search_cache_entry(self, position: int) -> BibEntry:
         """
-        Returns the result of a cached search.
+        Returns an entry of the cached search, or None if there is no entry
+        at that position.
+
+        :param position: The position of the entry, starting at 1.
         """
-        last_results_fname = os.path.join(self.config.bibsearch_dir, "lastSearch.yml")
-        if os.path.exists(last_results_fname):
-            return yaml.load(open(last_results_fname))
+        self.cursor.execute("""SELECT search_cache.key, search_cache.fulltext, %s
+                               FROM search_cache LEFT JOIN bib
+                               ON bib.rowid = search_cache.entry AND bib.key = search_cache.key
+                               WHERE position = ?""" % _ENTRY_COLUMNS, [position])
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        key, fulltext, rowid = row[:3]
+        if rowid is not None:
+            return BibEntry.from_row(row[2:])
+        if fulltext is not None:
+            return BibEntry.from_pybtex(bibutils.fulltext_to_single_entry(fulltext), key)
+        # The entry has been removed from the database since, and its rowid
+        # possibly reused by another entry
+        return None
+
+    def search_cache_size(self) -> int:
+        self.cursor.execute("SELECT COUNT(*) FROM search_cache")
+        return self.cursor.fetchone()[0]
+
+    @staticmethod
+    def _quote_fts_term(term):
+        # A trailing * makes a prefix query
+        if term.endswith("*") and len(term) > 1:
+            return '"%s"*' % term[:-1].replace('"', '""')
+        return '"%s"' % term.replace('"', '""')
 
     def _format_query_fts(self, query_terms):
         processed_query_terms = []
@@ -124,14 +622,16 @@ class BibDB:
                         current_term.startswith("key:") or
                         current_term.startswith("title:") or
                         current_term.startswith("venue:") or
+                        current_term.startswith("abstract:") or
+                        current_term.startswith("keywords:") or
                         current_term.startswith("year")):
                     # Protect the whole sequence
                     if current_term[0] != '"' and current_term[-1] != '"':
-                        current_term = '"%s"' % current_term
+                        current_term = self._quote_fts_term(current_term)
                 else:
                     specifier, query = current_term.split(":", 1)
                     quoted_query = query if (query[0] == '"' and query[-1] == '"') \
-                                         else '"%s"' % query
+                                         else self._quote_fts_term(query)
                     if specifier == "key":
                         current_term = '(key:%s OR custom_key:%s)' % (quoted_query, quoted_query)
                     else:
@@ -139,51 +639,361 @@ class BibDB:
             processed_query_terms.append(current_term)
         return " AND ".join(processed_query_terms)
 
+    def _format_term_no_fts(self, term):
+        """
+        Translates a search term into a condition on the bib table, which
+        looks its words up in the postings table. A term in double quotes
+        must also match the words in order.
+
+        :return: A tuple (condition, values, lookups), where lookups are
+                 the postings lookups (term condition and its values) that
+                 any matching entry must satisfy.
+        """
+        if term in self.config.macros:
+            # Macros are FTS queries, of which only ORs of terms are supported
+            alternatives = []
+            alternative_values = []
+            for alternative in self.config.macros[term].strip("()").split(" OR "):
+                clause, values = self._format_query_no_fts(_query_term_re.findall(alternative))
+                alternatives.append("(%s)" % clause)
+                alternative_values.extend(values)
+            return "(%s)" % " OR ".join(alternatives), alternative_values, []
+
+        specifier, query = None, term
+        if term.split(":", 1)[0] in self.column_names_no_key + ["key"]:
+            specifier, query = term.split(":", 1)
+        if specifier == "key":
+            columns = ["key", "custom_key"]
+        elif specifier:
+            columns = [specifier]
+        else:
+            columns = _POSTINGS_COLUMNS
+        tokens = bibutils.index_tokens(query)
+        if not tokens:
+            return "0", [], []
+
+        lookups = []
+        for i, token in enumerate(tokens):
+            if i == len(tokens) - 1 and query.endswith("*"):
+                lookups.append(("term >= ? AND term < ?", [token, token + "\U0010ffff"]))
+            else:
+                lookups.append(("term = ?", [token]))
+        column_condition = ""
+        if specifier:
+            column_condition = " AND col IN (%s)" % ",".join(str(_POSTINGS_COLUMNS.index(c)) for c in columns)
+        conditions = []
+        values = []
+        for term_condition, term_values in lookups:
+            conditions.append("EXISTS (SELECT 1 FROM postings WHERE %s AND entry = bib.rowid%s)"
+                              % (term_condition, column_condition))
+            values.extend(term_values)
+        if len(tokens) > 1 and len(query) > 1 and query[0] == '"' and query[-1] == '"':
+            conditions.append("(%s)" % " OR ".join("%s LIKE ?" % _FOLDED_COLUMNS.get(c, c) for c in columns))
+            values.extend(["%%%s%%" % "%".join(tokens)] * len(columns))
+        return " AND ".join(conditions), values, lookups
+
     def _format_query_no_fts(self, input_terms):
         query_terms = []
         query_values = []
+        lookups = []
         for t in input_terms:
-            if not functools.reduce(lambda x, y: x or y,
-                                    [t.startswith(c + ":")
-                                     for c in self.column_names_no_key + ["key"]]):
-                current_terms = []
-                for c in self.column_names_no_key + ["key", "custom_key"]:
-                    current_terms.append('(%s LIKE ?)' % c)
-                    query_values.append('%%%s%%' % t)
-                query_terms.append("(%s)" % " OR ".join(current_terms))
-            else:
-                specifier, query = t.split(":", 1)
-                wildquery = '%%%s%%' % query
-                if specifier == "key":
-                    query_terms.append('((key LIKE ?) OR (custom_key LIKE ?))')
-                    query_values.append(wildquery)
-                    query_values.append(wildquery)
-                else:
-                    query_terms.append('(%s LIKE ?)' % specifier)
-                    query_values.append(wildquery)
+            clause, values, term_lookups = self._format_term_no_fts(t)
+            query_terms.append(clause)
+            query_values.extend(values)
+            lookups.extend(term_lookups)
+        if lookups:
+            # The entries are enumerated from the shortest postings list, and
+            # the other conditions checked for each of them. The lists are
+            # only counted up to a bound, so that long ones are cheap to skip.
+            def postings_count(lookup):
+                term_condition, term_values = lookup
+                self.cursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM postings WHERE %s LIMIT 1000)"
+                                    % term_condition, term_values)
+                return self.cursor.fetchone()[0]
+            term_condition, term_values = min(lookups, key=postings_count)
+            query_terms.insert(0, "rowid IN (SELECT entry FROM postings WHERE %s)" % term_condition)
+            query_values[0:0] = term_values
         return " AND ".join(query_terms), query_values
 
-    def search(self, query: str):
+    def _bm25_weights(self) -> List[float]:
+        """
+        Returns the bm25 weights of the FTS columns, as set in the
+        search_weights config option. Unspecified columns have weight 1.
+        """
+        weights = collections.OrderedDict((column, 1.0) for column in _FTS_COLUMNS)
+        for item in self.config.search_weights.split():
+            column, _, weight = item.partition("=")
+            if column not in weights or column == "fulltext":
+                logging.error("Unknown column '%s' in search_weights", column)
+                sys.exit(1)
+            try:
+                weights[column] = float(weight)
+            except ValueError:
+                logging.error("Invalid weight '%s' for column '%s' in search_weights", weight, column)
+                sys.exit(1)
+        # The fulltext is not indexed
+        weights["fulltext"] = 0.0
+        return list(weights.values())
+
+    def _format_query_body(self, query_terms):
+        # The text has no columns, terms are only quoted unless already
+        return " AND ".join(t if len(t) > 1 and t[0] == '"' and t[-1] == '"' else self._quote_fts_term(t)
+                            for t in query_terms)
+
+    def _search_query(self, query: List[str], body: bool = False) -> tuple:
         """
-        Performs a search against the private database.
+        Returns the SQL statement selecting the rowids of the entries
+        matching the search terms, best first, and its parameters.
 
-        :param query: The search query.
-        :return: A list of search results.
+        :param body: Whether to search the text of the PDFs instead.
         """
+        if body:
+            if not self.has_fts:
+                logging.error("Searching the text of papers requires FTS5 support in sqlite3")
+                sys.exit(1)
+            return ("SELECT rowid FROM bodyindex WHERE bodyindex MATCH ? ORDER BY bm25(bodyindex)",
+                    [self._format_query_body(query)])
         if self.has_fts:
-            self.cursor.execute("SELECT fulltext, key FROM bibindex \
-                                WHERE bibindex MATCH ?",
-                                [self._format_query_fts(query)])
+            weights = self._bm25_weights()
+            return ("""SELECT rowid FROM bibindex WHERE bibindex MATCH ?
+                       ORDER BY bm25(bibindex, %s)""" % ", ".join("?" * len(weights)),
+                    [self._format_query_fts(query)] + weights)
         else:
             where_clause, query_values = self._format_query_no_fts(query)
-            self.cursor.execute("SELECT fulltext, key FROM bib \
-                                    WHERE %s" % where_clause,
-                                query_values)
-        results = list(self.cursor)
+            return "SELECT rowid FROM bib WHERE %s ORDER BY rowid" % where_clause, query_values
+
+    def _update_fuzzy_index(self):
+        """
+        Adds the words of the entries inserted since the last update to the
+        trigram index used by fuzzy searches, creating it if needed. Words
+        are not removed, as stale ones just do not match anything.
+        """
+        if not self.has_fuzzy_index:
+            self.cursor.executescript("""
+                CREATE TABLE fuzzy_terms (term text PRIMARY KEY) WITHOUT ROWID;
+                -- size is the number of trigrams of the term, so that terms of
+                -- very different length can be skipped in the index
+                CREATE TABLE fuzzy_trigrams (
+                    trigram text,
+                    size integer,
+                    term text,
+                    PRIMARY KEY (trigram, size, term)
+                ) WITHOUT ROWID;""")
+            self.has_fuzzy_index = True
+        self.cursor.execute("SELECT value FROM stats WHERE name = 'fuzzy_indexed_rowid'")
+        row = self.cursor.fetchone()
+        indexed_rowid = row[0] if row else 0
+        self.cursor.execute("SELECT IFNULL(MAX(rowid), 0) FROM bib")
+        max_rowid = self.cursor.fetchone()[0]
+        if max_rowid <= indexed_rowid:
+            return
+        if max_rowid - indexed_rowid > 10000:
+            logging.info("Updating the index for fuzzy searches...")
+        self.cursor.execute("SELECT key, custom_key, author, title, venue FROM bib WHERE rowid > ?",
+                            [indexed_rowid])
+        words = set()
+        for row in self.cursor.fetchall():
+            for text in row:
+                words.update(bibutils.index_words(text))
+        self._add_fuzzy_terms(words)
+        self.cursor.execute("INSERT OR REPLACE INTO stats(name, value) VALUES ('fuzzy_indexed_rowid', ?)",
+                            [max_rowid])
+        self.save()
+
+    def _add_fuzzy_terms(self, words: set):
+        words = [word for word in words if len(word) >= 3]
+        new_words = set(words)
+        for chunk_start in range(0, len(words), 500):
+            chunk = words[chunk_start:chunk_start + 500]
+            self.cursor.execute("SELECT term FROM fuzzy_terms WHERE term IN (%s)" % ",".join("?" * len(chunk)),
+                                chunk)
+            new_words.difference_update(term for term, in self.cursor)
+        self.cursor.executemany("INSERT INTO fuzzy_terms(term) VALUES (?)", [(word,) for word in new_words])
+        rows = []
+        for word in new_words:
+            word_trigrams = bibutils.trigrams(word)
+            rows.extend((trigram, len(word_trigrams), word) for trigram in word_trigrams)
+        self.cursor.executemany("INSERT INTO fuzzy_trigrams(trigram, size, term) VALUES (?,?,?)", rows)
+
+    def similar_terms(self, word: str, limit: int = 5, threshold: float = 0.5) -> List[tuple]:
+        """
+        Looks up the indexed words most similar to word, by the Dice
+        coefficient of their trigrams.
+
+        :param word: A single word.
+        :param limit: The maximum number of words returned.
+        :param threshold: The minimum similarity, between 0 and 1.
+        :return: A list of (word, similarity) tuples, most similar first.
+        """
+        word_trigrams = list(bibutils.trigrams(bibutils.fold(word)))
+        size = len(word_trigrams)
+        # Terms with fewer or more trigrams cannot reach the threshold
+        min_size = size * threshold / (2 - threshold)
+        max_size = size * (2 - threshold) / threshold
+        self.cursor.execute("""SELECT term, size, COUNT(*) FROM fuzzy_trigrams
+                               WHERE trigram IN (%s) AND size BETWEEN ? AND ?
+                               GROUP BY term""" % ",".join("?" * size),
+                            word_trigrams + [min_size, max_size])
+        candidates = []
+        for term, term_size, common in self.cursor:
+            similarity = 2 * common / (size + term_size)
+            if similarity >= threshold:
+                candidates.append((term, similarity))
+        candidates.sort(key=lambda candidate: (-candidate[1], candidate[0]))
+        return candidates[:limit]
+
+    def _fuzzy_queries(self, query: List[str], limit: int = 20) -> List[List[str]]:
+        """
+        Expands the search terms into queries where words are replaced by
+        similar indexed words, ordered by decreasing similarity to the
+        original query. Words that are not indexed are only kept when no
+        similar word is found. The original query comes first, if kept.
+        """
+        self._update_fuzzy_index()
+        queries = [(1.0, [])]
+        for term in query:
+            specifier, word = "", term
+            if term.split(":", 1)[0] in ["author", "title", "venue", "year", "key"]:
+                specifier, word = term.split(":", 1)
+                specifier += ":"
+            alternatives = [(1.0, term)]
+            if term not in self.config.macros and word.isalpha() and len(word) >= 3:
+                candidates = self.similar_terms(word)
+                # A word that is not indexed cannot match: keeping it would
+                # fill the best queries with ones that find nothing
+                if candidates and bibutils.fold(word) not in [similar for similar, _ in candidates]:
+                    alternatives = []
+                alternatives.extend((similarity, specifier + similar)
+                                    for similar, similarity in candidates
+                                    if similar != bibutils.fold(word))
+            # The best queries can only extend the best shorter ones
+            queries = heapq.nlargest(limit,
+                                     ((similarity * alternative_similarity, terms + [alternative])
+                                      for similarity, terms in queries
+                                      for alternative_similarity, alternative in alternatives),
+                                     key=lambda q: q[0])
+        return [terms for _, terms in queries]
+
+    def iter_search(self, query: List[str], limit: int = None, offset: int = 0, fuzzy: bool = False,
+                    body: bool = False):
+        """
+        Performs a search against the private database. The matches are
+        saved to the search cache before the first one is returned, and the
+        entries are read from the database as they are consumed.
+
+        With FTS, the results are ranked with bm25, otherwise they are
+        returned in insertion order. Fuzzy searches also return the matches
+        of words similar to the search terms, ranked by their similarity.
 
-        self.save_to_search_cache(results)
+        :param query: The search terms. If empty, the entries of the
+                      last search are returned again.
+        :param limit: The maximum number of results, or None for all.
+        :param offset: The number of results to skip.
+        :param fuzzy: Whether to tolerate misspelled search terms.
+        :param body: Whether to search the text of the downloaded PDFs
+                     (see store_body) instead of the entries.
+        :return: A generator over BibEntry objects.
+        """
+        # Not self.cursor, which may be used while the results are consumed
+        cursor = self.connection.cursor()
+        # The matching rowids are written to the search cache in order, and
+        # the entries then read from there. Without a query, the results of
+        # the last search are returned.
+        if query:
+            # Entries are stored in Unicode, so TeX in the query would not match
+            query = [bibutils.tex_to_unicode(term) for term in query]
+            cursor.execute("DELETE FROM search_cache")
+            if fuzzy:
+                wanted = -1 if limit is None else offset + limit
+                rowids = collections.OrderedDict()
+                for fuzzy_query in self._fuzzy_queries(query):
+                    sql, parameters = self._search_query(fuzzy_query, body)
+                    cursor.execute(sql + " LIMIT ?", parameters + [wanted])
+                    rowids.update((rowid, None) for rowid, in cursor)
+                    if wanted >= 0 and len(rowids) >= wanted:
+                        break
+                rowids = list(rowids)[offset:None if limit is None else offset + limit]
+                cursor.executemany("INSERT INTO search_cache(entry) VALUES (?)", [(rowid,) for rowid in rowids])
+            else:
+                sql, parameters = self._search_query(query, body)
+                cursor.execute("INSERT INTO search_cache(entry) %s LIMIT ? OFFSET ?" % sql,
+                               parameters + [-1 if limit is None else limit, offset])
+            # The key tells whether the rowid still refers to the same entry
+            # when the cache is read, as removed rowids can be reused
+            cursor.execute("UPDATE search_cache SET key = (SELECT key FROM bib WHERE bib.rowid = search_cache.entry)")
+            self.save()
+
+        cursor.execute("""SELECT %s FROM search_cache
+                          JOIN bib ON bib.rowid = search_cache.entry AND bib.key = search_cache.key
+                          ORDER BY search_cache.position""" % _ENTRY_COLUMNS)
+        for row in cursor:
+            yield BibEntry.from_row(row)
+
+    def search(self, query: List[str], limit: int = None, offset: int = 0, fuzzy: bool = False,
+               body: bool = False) -> List[BibEntry]:
+        """
+        Performs a search against the private database, see iter_search.
+
+        :param query: The search terms.
+        :return: A list of BibEntry objects.
+        """
+        return list(self.iter_search(query, limit, offset, fuzzy, body))
 
-        return results
+    def complete(self, partial: str, limit: int = 10) -> List[tuple]:
+        """
+        Completes a partially typed key or title. Entries with a key
+        starting with partial come first, followed by the entries whose
+        title contains the words of partial, the last one as a prefix.
+        Titles are only completed once the last word has two characters,
+        the shortest prefix in the FTS prefix indexes.
+
+        :param partial: The text typed so far.
+        :param limit: The maximum number of candidates.
+        :return: A list of (key, title) tuples, using the custom keys.
+        """
+        candidates = collections.OrderedDict()
+        if partial and not any(c.isspace() for c in partial):
+            # Range scans on the indexes of the key columns
+            for column in ["custom_key", "key"]:
+                self.cursor.execute("""SELECT custom_key, key, title FROM bib
+                                       WHERE {0} >= ? AND {0} < ? ORDER BY {0} LIMIT ?""".format(column),
+                                    [partial, partial + "\U0010ffff", limit])
+                for custom_key, key, title in self.cursor:
+                    candidates.setdefault(custom_key or key, title)
+
+        words = partial.split()
+        if len(candidates) < limit and words and len(words[-1]) >= 2:
+            if self.has_fts:
+                # Prefixes longer than those in the prefix indexes are
+                # expanded to all matching words, which is slow if one of them
+                # is frequent. As the last word is often complete already,
+                # it is first looked up as a whole word.
+                last_words = [words[-1] + "*"]
+                if len(words[-1]) > 3:
+                    last_words.insert(0, words[-1])
+                for last_word in last_words:
+                    query = " AND ".join("title:" + self._quote_fts_term(w) for w in words[:-1] + [last_word])
+                    # Ranking would need to score every match of short
+                    # prefixes, so the most recently added entries are
+                    # returned instead
+                    self.cursor.execute("""SELECT bib.custom_key, bib.key, bib.title FROM
+                                             (SELECT rowid FROM bibindex WHERE bibindex MATCH ?
+                                              ORDER BY rowid DESC LIMIT ?) AS hits
+                                           JOIN bib ON bib.rowid = hits.rowid ORDER BY hits.rowid DESC""",
+                                        [query, limit])
+                    for custom_key, key, title in self.cursor:
+                        candidates.setdefault(custom_key or key, title)
+                    if len(candidates) >= limit:
+                        break
+            else:
+                where_clause, values = self._format_query_no_fts(["title:" + w for w in words[:-1]] +
+                                                                 ["title:%s*" % words[-1]])
+                self.cursor.execute("SELECT custom_key, key, title FROM bib WHERE %s ORDER BY rowid DESC LIMIT ?"
+                                    % where_clause, values + [limit])
+                for custom_key, key, title in self.cursor:
+                    candidates.setdefault(custom_key or key, title)
+
+        return list(candidates.items())[:limit]
 
     def search_key(self, key) -> str:
         """
@@ -193,12 +1003,36 @@ class BibDB:
         :param key: The key to search on (key or custom key)
         :return: The full-text entry.
         """
-        self.cursor.execute("SELECT fulltext FROM bib WHERE key=? OR custom_key=?",
-                            [key, key])
-        entry = self.cursor.fetchone()
-        if entry is not None:
-            entry = bibutils.single_entry_to_fulltext(bibutils.fulltext_to_single_entry(entry[0]), overwrite_key=key)
-        return entry
+        return self.search_keys([key]).get(key)
+
+    def search_keys(self, keys: List[str]) -> dict:
+        """
+        Looks up several keys or custom keys at once, see search_key.
+
+        :param keys: The keys to search on.
+        :return: A dict from each key found to its full-text entry, with the
+                 key as the entry key.
+        """
+        keys = list(set(keys))
+        by_key = {}
+        by_custom_key = {}
+        # Each key is bound twice, and SQLite before 3.32 allows at most
+        # 999 variables in a statement
+        for chunk_start in range(0, len(keys), 499):
+            chunk = keys[chunk_start:chunk_start + 499]
+            placeholders = ",".join("?" * len(chunk))
+            self.cursor.execute("SELECT key, custom_key, fulltext FROM bib WHERE key IN (%s) OR custom_key IN (%s)"
+                                % (placeholders, placeholders), chunk + chunk)
+            for key, custom_key, fulltext in self.cursor:
+                by_key[key] = fulltext
+                by_custom_key[custom_key] = fulltext
+        entries = {}
+        for key in keys:
+            # Original keys take precedence, should they clash with custom ones
+            fulltext = by_key.get(key, by_custom_key.get(key))
+            if fulltext is not None:
+                entries[key] = bibutils.replace_entry_key(fulltext, key)
+        return entries
 
     def save(self):
         self.connection.commit()
@@ -206,79 +1040,224 @@ class BibDB:
     def remove(self, key: str):
         """Removes the entry"""
 
+        self._unindex_postings("key=? or custom_key=?", [key, key])
         self.cursor.execute('DELETE FROM bib WHERE key=? or custom_key=?', [key, key])
+        if self.has_fuzzy_index:
+            # The rowid of the last entry is reused by the next one, whose
+            # words _update_fuzzy_index would then skip
+            self.cursor.execute("""UPDATE stats SET value = (SELECT IFNULL(MAX(rowid), 0) FROM bib)
+                                   WHERE name = 'fuzzy_indexed_rowid'
+                                   AND value > (SELECT IFNULL(MAX(rowid), 0) FROM bib)""")
+
+    @contextlib.contextmanager
+    def bulk_import(self, batch_size: int = 1000):
+        """
+        Context manager for adding a large number of entries. Inside the
+        block, `add` checks duplicates and custom keys against in-memory
+        sets instead of relying on UNIQUE violations, and queues the rows,
+        which are inserted in batches with `executemany`. Every batch is
+        inserted and indexed in a short transaction of its own (see
+        _flush_bulk_rows), so that entries are available while the import
+        goes on and other commands are not locked out while entries are
+        downloaded or parsed.
+
+        :param batch_size: Number of rows queued before they are inserted.
+        """
+        self.cursor.execute("SELECT key, custom_key FROM bib")
+        self._bulk_keys = set()
+        self._bulk_custom_keys = set()
+        self._bulk_suffix_levels = {}
+        for key, custom_key in self.cursor:
+            self._bulk_keys.add(key)
+            self._bulk_custom_keys.add(custom_key)
+        self._bulk_rows = []
+        self._bulk_files = []
+        self._bulk_batch_size = batch_size
+        try:
+            yield
+            self._flush_bulk_rows()
+        finally:
+            self._bulk_rows = None
+            self._bulk_files = None
+            self._bulk_keys = None
+            self._bulk_custom_keys = None
+            self._bulk_suffix_levels = None
+
+    def _flush_bulk_rows(self):
+        """
+        Inserts the queued rows and indexes them in a single pass, which is
+        much faster than the FTS insert trigger. The trigger is dropped and
+        restored within the same transaction, so other connections never
+        see it missing.
+        """
+        if not self._bulk_rows and not self._bulk_files:
+            return
+        if not self.connection.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Rows get consecutive rowids, so the new ones are exactly those
+            # above the current maximum
+            self.cursor.execute("SELECT IFNULL(MAX(rowid), 0) FROM bib")
+            last_rowid = self.cursor.fetchone()[0]
+            if self.has_fts:
+                self.cursor.execute("DROP TRIGGER bib_ai")
+            self.cursor.executemany("""INSERT INTO bib(key, custom_key, author, title, venue, year, fields, fulltext,
+                                                       folded_author, folded_title, folded_venue, abstract, keywords)
+                                       VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                                    self._bulk_rows)
+            if self.has_fts:
+                self.cursor.execute("""INSERT INTO bibindex
+                    (rowid, {columns})
+                    SELECT rowid, {columns}
+                    FROM bib WHERE rowid > ?""".format(columns=", ".join(_FTS_COLUMNS)),
+                                    [last_rowid])
+                self.cursor.execute(_fts_insert_trigger(_FTS_COLUMNS))
+            else:
+                self._index_postings("rowid > ?", [last_rowid])
+            for file_info in self._bulk_files:
+                self._store_file_downloaded(*file_info)
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self._bulk_rows = []
+        self._bulk_files = []
+        self.save()
 
-    def add(self, entry: pybtex.Entry):
+    def _split_custom_key(self, key_fields):
+        if key_fields is None:
+            return None
+        try:
+            return bibutils.split_custom_key(key_fields, self.config.custom_key_format)
+        except Exception:
+            return None
+
+    def _taken_suffixes(self, prefix, tail):
+        """
+        Returns the suffixes already in use for custom keys of the form
+        prefix + suffix + tail, with a single range scan of the custom key
+        index.
+        """
+        # Nothing sorts after U+10FFFF, so this covers all keys with the prefix
+        self.cursor.execute("SELECT custom_key FROM bib WHERE custom_key >= ? AND custom_key < ?",
+                            [prefix, prefix + "\U0010ffff"])
+        taken = set()
+        for custom_key, in self.cursor:
+            if len(custom_key) >= len(prefix) + len(tail) and custom_key.endswith(tail):
+                taken.add(custom_key[len(prefix):len(custom_key) - len(tail)])
+        return taken
+
+    def _allocate_custom_key(self, key_fields):
+        """
+        Returns the first free custom key for an entry, or None if no custom
+        key can be generated for it.
+        """
+        parts = self._split_custom_key(key_fields)
+        if parts is None:
+            return None
+        prefix, tail = parts
+        if self._bulk_rows is not None:
+            # Keys are never removed during an import, so the levels below
+            # the last one handed out for this prefix are still taken
+            suffix_level = self._bulk_suffix_levels.get(parts, 0)
+            while prefix + bibutils.custom_key_suffix(suffix_level) + tail in self._bulk_custom_keys:
+                suffix_level += 1
+            self._bulk_suffix_levels[parts] = suffix_level
+        else:
+            taken = self._taken_suffixes(prefix, tail)
+            suffix_level = 0
+            while bibutils.custom_key_suffix(suffix_level) in taken:
+                suffix_level += 1
+        return prefix + bibutils.custom_key_suffix(suffix_level) + tail
+
+    def _bulk_add(self, row):
+        """Queues a prepared entry while inside a `bulk_import` block."""
+        original_key, key_fields, utf_author, utf_title, utf_venue, year, fields, fulltext = row
+        custom_key = self._allocate_custom_key(key_fields)
+        self._bulk_keys.add(original_key)
+        if custom_key is not None:
+            self._bulk_custom_keys.add(custom_key)
+            fulltext = bibutils.replace_entry_key(fulltext, custom_key)
+        self._bulk_rows.append((original_key,
+                                custom_key,
+                                utf_author,
+                                utf_title,
+                                utf_venue,
+                                year,
+                                fields,
+                                fulltext,
+                                bibutils.fold(utf_author),
+                                bibutils.fold(utf_title),
+                                bibutils.fold(utf_venue))
+                               + bibutils.long_fields(fields))
+        if len(self._bulk_rows) >= self._bulk_batch_size:
+            self._flush_bulk_rows()
+        return True, []
+
+    def add(self, entry: "pybtex.Entry"):
         """ Returns if the entry was added or if it was a duplicate"""
 
         # TODO: make this a better sanity checking and perhaps report errors
         if not entry.key:
-            return False
-        if not entry.persons.get("author"):
-            entry.persons["author"] = [pybtex.Person("UNKNOWN")]
-
-        original_key = entry.key
-        entry.fields["original_key"] = original_key
-        utf_author = bibutils.authors_to_unicode(entry)
-        utf_title = bibutils.field_to_unicode(entry, "title")
-        utf_venue = bibutils.field_to_unicode(entry, "journal")
-        if not utf_venue:
-            utf_venue = bibutils.field_to_unicode(entry, "booktitle")
-        custom_key_tries = 0
-        added = False
-        warnings = []
-        while not added:
-            custom_key = None
-            if custom_key_tries < 27:
-                try:
-                    custom_key = bibutils.generate_custom_key(entry, self.config.custom_key_format, custom_key_tries)
-                except Exception as e:
-                    pass
-            else:
-                warnings.append("Could not generate a unique custom key for entry %s" % original_key)
-                custom_key = original_key
-            try:
-                self.cursor.execute('INSERT INTO bib(key, custom_key, author, title, venue, year, fulltext) VALUES (?,?,?,?,?,?,?)',
-                                    (original_key,
-                                     custom_key,
-                                     utf_author,
-                                     utf_title,
-                                     utf_venue,
-                                     str(entry.fields.get("year")),
-                                     bibutils.single_entry_to_fulltext(entry, custom_key)
-                                    )
-                                   )
-                added = True
-            except sqlite3.IntegrityError as e:
-                error_message = str(e)
-                if "UNIQUE" in error_message:
-                    if "bib.custom_key" in error_message:
-                        # custom_key was already in the DB
-                        custom_key_tries += 1
-                    elif "bib.key" in error_message:
-                        # duplicate entry
-                        break
-                    else:
-                        raise
-                else:
-                    raise
-        return added, warnings
+            return False, []
+        if self._bulk_keys is not None and entry.key in self._bulk_keys:
+            # Duplicate entry, no need to process it any further
+            return False, []
+        return self.add_prepared(bibutils.prepare_entry(entry))
+
+    def add_prepared(self, row: tuple):
+        """
+        Adds an entry already processed by `bibutils.prepare_entry`.
+        Returns if the entry was added or if it was a duplicate.
+        """
+        if self._bulk_rows is not None:
+            if row[0] in self._bulk_keys:
+                return False, []
+            return self._bulk_add(row)
+
+        original_key, key_fields, utf_author, utf_title, utf_venue, year, fields, fulltext = row
+        self.cursor.execute("SELECT 1 FROM bib WHERE key = ?", [original_key])
+        if self.cursor.fetchone() is not None:
+            # duplicate entry
+            return False, []
+        custom_key = self._allocate_custom_key(key_fields)
+        self.cursor.execute("""INSERT INTO bib(key, custom_key, author, title, venue, year, fields, fulltext,
+                                               folded_author, folded_title, folded_venue, abstract, keywords)
+                               VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                            (original_key,
+                             custom_key,
+                             utf_author,
+                             utf_title,
+                             utf_venue,
+                             year,
+                             fields,
+                             bibutils.replace_entry_key(fulltext, custom_key) if custom_key else fulltext,
+                             bibutils.fold(utf_author),
+                             bibutils.fold(utf_title),
+                             bibutils.fold(utf_venue)
+                            ) + bibutils.long_fields(fields)
+                           )
+        self._index_postings("rowid = ?", [self.cursor.lastrowid])
+        return True, []
 
     def update_custom_key(self, original_key, new_custom_key):
         self.cursor.execute("SELECT fulltext FROM bib WHERE key=? LIMIT 1", (original_key,))
         entry = bibutils.fulltext_to_single_entry(self.cursor.fetchone()[0])
         entry.key = new_custom_key
         try:
+            self._unindex_postings("key=?", [original_key])
             self.cursor.execute("UPDATE bib SET custom_key=?, fulltext=? WHERE key=?",
                                 [new_custom_key,
                                  bibutils.single_entry_to_fulltext(entry),
                                  original_key])
+            self._index_postings("key=?", [original_key])
+            if self.has_fuzzy_index:
+                self._add_fuzzy_terms(bibutils.index_words(new_custom_key))
             self.save()
         except:
             logging.error("Key %s already exists in the database", new_custom_key)
             sys.exit(1)
 
-    def update(self, entry: pybtex.Entry):
+    def update(self, entry: "pybtex.Entry"):
         """ Returns if the entry was added or if it was a duplicate"""
 
         # TODO: make this a better sanity checking and perhaps report errors
@@ -286,22 +1265,30 @@ class BibDB:
             return False
 
         original_key = entry.fields["original_key"]
-        utf_author = bibutils.authors_to_unicode(entry)
-        utf_title = bibutils.field_to_unicode(entry, "title")
-        utf_venue = bibutils.field_to_unicode(entry, "journal")
-        if not utf_venue:
-            utf_venue = bibutils.field_to_unicode(entry, "booktitle")
+        utf_author, utf_title, utf_venue = bibutils.display_fields(entry)
+        fields = bibutils.entry_to_json(entry)
+        self._unindex_postings("key=?", [original_key])
         try:
-            self.cursor.execute('UPDATE bib SET custom_key=?, author=?, title=?, venue=?, year=?, fulltext=? WHERE key=?',
+            self.cursor.execute("""UPDATE bib SET custom_key=?, author=?, title=?, venue=?, year=?, fields=?, fulltext=?,
+                                                 folded_author=?, folded_title=?, folded_venue=?, abstract=?, keywords=?
+                                   WHERE key=?""",
                                 (entry.key,
                                  utf_author,
                                  utf_title,
                                  utf_venue,
                                  str(entry.fields.get("year")),
+                                 fields,
                                  bibutils.single_entry_to_fulltext(entry),
-                                 original_key
-                                )
+                                 bibutils.fold(utf_author),
+                                 bibutils.fold(utf_title),
+                                 bibutils.fold(utf_venue))
+                                + bibutils.long_fields(fields)
+                                + (original_key,)
                                )
+            if self.has_fuzzy_index:
+                # _update_fuzzy_index only picks up new entries
+                self._add_fuzzy_terms(set().union(*(bibutils.index_words(text)
+                                                    for text in [entry.key, utf_author, utf_title, utf_venue])))
         except sqlite3.IntegrityError as e:
             error_message = str(e)
             if "UNIQUE" in error_message:
@@ -311,6 +1298,9 @@ class BibDB:
                     raise
             else:
                 raise
+        finally:
+            # The old contents if the update failed
+            self._index_postings("key=?", [original_key])
 
     def __iter__(self):
         self.cursor.execute("SELECT fulltext FROM bib")
@@ -320,9 +1310,35 @@ class BibDB:
     def file_has_been_downloaded(self, file):
         return self.cursor.execute("""SELECT 1 FROM downloaded_files WHERE file = ? LIMIT 1""", [file]).fetchone() is not None
 
-    def register_file_downloaded(self, file):
-        try:
-            self.cursor.execute("""INSERT INTO downloaded_files(file) VALUES (?)""", [file])
-        except sqlite3.IntegrityError:
-            # File was already registered. No problem.
-            pass
+    def get_downloaded_file(self, file) -> dict:
+        """
+        Returns what is known about a previously downloaded file, as a dict
+        with the keys "etag", "last_modified", "size" and "sha256" (the values
+        can be None). Returns None if the file has not been downloaded.
+        """
+        self.cursor.execute("""SELECT etag, last_modified, size, sha256
+                               FROM downloaded_files WHERE file = ? LIMIT 1""", [file])
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(["etag", "last_modified", "size", "sha256"], row))
+
+    def downloaded_files(self):
+        self.cursor.execute("SELECT file FROM downloaded_files ORDER BY rowid")
+        return [row[0] for row in self.cursor]
+
+    def register_file_downloaded(self, file, etag=None, last_modified=None, size=None, sha256=None):
+        if self._bulk_rows is not None:
+            # Stored with the next batch, after the entries of the file
+            self._bulk_files.append((file, etag, last_modified, size, sha256))
+        else:
+            self._store_file_downloaded(file, etag, last_modified, size, sha256)
+
+    def _store_file_downloaded(self, file, etag, last_modified, size, sha256):
+        self.cursor.execute("""UPDATE downloaded_files SET etag=?, last_modified=?, size=?, sha256=?
+                               WHERE file=?""",
+                            [etag, last_modified, size, sha256, file])
+        if self.cursor.rowcount == 0:
+            self.cursor.execute("""INSERT INTO downloaded_files(file, etag, last_modified, size, sha256)
+                                   VALUES (?,?,?,?,?)""",
+                                [file, etag, last_modified, size, sha256])
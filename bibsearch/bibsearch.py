@@ -14,23 +14,33 @@ Authors:
 """
 
 import argparse
+import collections
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
 import logging
 import os
 import re
 import sys
-from typing import List, Tuple
-import urllib.request
-import pybtex.database as pybtex
+from typing import List, TYPE_CHECKING
 import subprocess
 import tempfile
 import textwrap
-from tqdm import tqdm
-import yaml
+import time
+import traceback
 
-from pkg_resources import resource_filename, resource_exists
 
-from .bibdb import BibDB
+from .bibdb import BibDB, BibEntry
 from . import bibutils
+from . import daemon
+
+# The modules imported only by some commands are imported by the functions
+# using them, so that quick commands (or a request to a running server)
+# do not pay for them
+if TYPE_CHECKING:
+    import pybtex.database as pybtex
 from .config import Config
 
 VERSION = '0.3.14'
@@ -82,6 +92,7 @@ def download_file(url, fname_out=None) -> None:
     """
 
     import ssl
+    import urllib.request
 
     #~ logging.info('Downloading {} to {}'.format(url, fname_out if fname_out is not None else 'STR'))
     # check if the file has already been downloaded
@@ -94,18 +105,13 @@ def download_file(url, fname_out=None) -> None:
         logging.debug('Downloading "%s"', url)
 
     try:
+        if fname_out:
+            # Only complete files are moved into place, so that they can be
+            # relied upon as a cache
+            from .fetch import Fetcher
+            return Fetcher().download(url, fname_out)
         with urllib.request.urlopen(url) as f:
-            if not fname_out:
-                return f.read().decode("utf-8")
-            else:
-                fdir = os.path.dirname(fname_out)
-                if not os.path.exists(fdir):
-                    os.makedirs(fdir)
-
-                with open(fname_out, "wb") as outfile:
-                    outfile.write(f.read())
-
-                return fname_out
+            return f.read().decode("utf-8")
 
     except ssl.SSLError:
         logging.warning('An SSL error was encountered in downloading the files. If you\'re on a Mac, '
@@ -114,24 +120,72 @@ def download_file(url, fname_out=None) -> None:
         sys.exit(1)
 
 
-def download_entry(entry: pybtex.Entry,
-                   config) -> str:
+def entry_pdf_path(entry: "pybtex.Entry", config) -> str:
     """
-    Downloads an entry's PDF using its "url" field, and returns the file path.
+    Returns the path an entry's PDF is downloaded to.
+    """
+    return os.path.join(config.download_dir, entry.fields['year'], entry.key + ".pdf")
 
-    :param entry: The pybtex.Entry item.
+
+def _pdf_object_path(sha256: str, config) -> str:
+    return os.path.join(config.download_dir, "objects", sha256[:2], sha256 + ".pdf")
+
+
+def store_pdf(pdf_path: str, config) -> tuple:
+    """
+    Adds a downloaded PDF to the store under download_dir/objects, where
+    files are named by their checksum. pdf_path is left as a hard link to the
+    stored file, so that a paper downloaded for several entries is only
+    stored once.
+
+    :param pdf_path: The downloaded file.
     :param config: The config object.
-    :return: The downloaded path.
+    :return: The (path, size, sha256, mtime) of the PDF, see BibDB.store_pdfs.
+    """
+    checksum = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(chunk)
+    sha256 = checksum.hexdigest()
+    object_path = _pdf_object_path(sha256, config)
+    try:
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            os.link(pdf_path, object_path)
+        except FileExistsError:
+            if not os.path.samefile(pdf_path, object_path):
+                # Already stored for another entry, link to that copy instead
+                os.link(object_path, pdf_path + ".link")
+                os.replace(pdf_path + ".link", pdf_path)
+    except OSError as e:
+        logging.debug('Could not store "%s" as "%s" (%s)', pdf_path, object_path, e)
+    stat = os.stat(pdf_path)
+    return pdf_path, stat.st_size, sha256, stat.st_mtime
+
+
+def download_entry(entry: "pybtex.Entry",
+                   config,
+                   fetcher=None,
+                   progress=None) -> tuple:
     """
+    Downloads an entry's PDF using its "url" field, unless it is already
+    there, and stores it with store_pdf.
 
-    outpath = None
-    if "url" not in entry.fields:
-        logging.error("Entry does not contain a URL field")
+    :param entry: The pybtex.Entry item.
+    :param config: The config object.
+    :param fetcher: The Fetcher to download with.
+    :param progress: Passed on to Fetcher.download.
+    :return: The (path, size, sha256, mtime) of the PDF.
+    """
+    outpath = entry_pdf_path(entry, config)
+    if os.path.exists(outpath):
+        logging.debug('Loading "%s" from cache at "%s"', entry.fields["url"], outpath)
     else:
-        outpath = os.path.join(config.download_dir, entry.fields['year'], entry.key + ".pdf")
-        download_file(entry.fields["url"], outpath)
-
-    return outpath
+        if fetcher is None:
+            from .fetch import Fetcher
+            fetcher = Fetcher()
+        fetcher.download(entry.fields["url"], outpath, progress)
+    return store_pdf(outpath, config)
 
 
 def pybtex_unescape(string: str) -> str:
@@ -144,105 +198,202 @@ def pybtex_unescape(string: str) -> str:
     return string.replace('\\_', '_').replace('\\textasciitilde ', '~')
 
 
-def format_search_results(results: List[Tuple[str,str]],
-                          output_format: str,
-                          use_original_key=False) -> str:
+def render_entry(entry: BibEntry,
+                 output_format: str,
+                 use_original_key=False,
+                 index="1") -> str:
     """
-    Formats a set of (Pybtex.Entry, custom_key) pairs for printing to the terminal.
-    Output can be either actual BibTeX or a summarized form.
+    Renders a single entry, see format_search_results.
 
-    :param results: A list of pairs of full bibtex entries and their associated keys
-    :param bibtex_output: Whether to retun the result as a bibtex entry instead of summarized text.
+    :param entry: The entry.
+    :param output_format: One of OUTPUT_FORMATS.
     :param use_original_key: Whether to use the default key instead of the custom one.
-    :return: An amalgamated string including all entries.
+    :param index: The position of the entry in the results, for the txt format.
+    :return: The rendered entry, including the trailing empty line.
     """
-
-    output = ""
-    for entryno, (fulltext, original_key) in enumerate(results, 1):
-        entry = bibutils.fulltext_to_single_entry(fulltext)
+    key = entry.key if use_original_key else entry.display_key
+    if output_format == 'bib':
+        fulltext = entry.fulltext
         if use_original_key:
-            entry.key = original_key
-            fulltext = bibutils.single_entry_to_fulltext(entry)
-        if output_format == 'bib':
-            output += pybtex_unescape(fulltext) + "\n"
-        else:
-            utf_author = bibutils.authors_to_unicode(entry)
+            fulltext = bibutils.replace_entry_key(fulltext, key)
+        return pybtex_unescape(fulltext) + "\n"
+
+    utf_title = entry.title or ""
+    utf_venue = entry.venue or ""
+    fields = entry.fields["fields"]
+    url = pybtex_unescape(fields.get('url', ''))
+    year = fields.get('year', '')
+
+    if output_format == 'txt':
+        textwrapper = textwrap.TextWrapper(subsequent_indent="   ")
+        lines = textwrapper.wrap('{index}. [{key}] {author}. {year}. "{title}". {venue}.\n{url}'.format(
+                        index=index,
+                        key=key,
+                        author=entry.author,
+                        title=utf_title,
+                        venue=utf_venue,
+                        year=year,
+                        url=url))
+        return "\n".join(lines) + "\n\n"
+
+    elif output_format == 'md':
+        return '{authors}. {year}.\n[{title}]({url})\n{venue}.'.format(
+            title=utf_title,
+            url=url,
+            authors=entry.author,
+            venue=utf_venue,
+            year=year) + '\n\n'
+    else:
+        raise ValueError("Unknown output format: %s" % output_format)
 
-            utf_title = bibutils.field_to_unicode(entry, "title", "")
-            utf_venue = bibutils.field_to_unicode(entry, "journal", "")
-            if not utf_venue:
-                utf_venue = bibutils.field_to_unicode(entry, "booktitle", "")
 
-            url = pybtex_unescape(entry.fields.get('url', ''))
-            year = entry.fields.get('year', '')
+def iter_formatted_results(results,
+                           output_format: str,
+                           use_original_key=False,
+                           db: BibDB = None,
+                           chunk_size=100):
+    """
+    Formats entries for printing to the terminal as they come, see
+    format_search_results.
 
-            if output_format == 'txt':
-                textwrapper = textwrap.TextWrapper(subsequent_indent="   ")
-                lines = textwrapper.wrap('{index}. [{key}] {author}. {year}. "{title}". {venue}.\n{url}'.format(
-                                index=entryno,
-                                key=entry.key,
-                                author=utf_author,
-                                title=utf_title,
-                                venue=utf_venue,
-                                year=entry.fields["year"],
-                                url=url))
-                output += "\n".join(lines) + "\n\n"
-
-            elif output_format == 'md':
-                output += '{authors}. {year}.\n[{title}]({url})\n{venue}.'.format(
-                    title=utf_title,
-                    url=url,
-                    authors=utf_author,
-                    venue=utf_venue,
-                    year=year) + '\n\n'
+    If a database is given, the renderings are cached in it, so that
+    entries that show up in later searches are not rendered again.
+    Cached renderings are looked up in chunks of chunk_size entries.
+
+    :param results: An iterable over BibEntry objects.
+    :return: A generator over the formatted entries.
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format: %s" % output_format)
+
+    def cache_format(entryno):
+        # The txt summary is wrapped including its index, so the rendering
+        # depends on the width of the index. It is cached with a placeholder
+        # of that width, which is replaced by the actual index.
+        if output_format == 'txt':
+            return 'txt:%d' % len(str(entryno))
+        return output_format
+
+    def format_chunk(chunk, first_entryno):
+        numbered = list(enumerate(chunk, first_entryno))
+        cached = {}
+        if db is not None:
+            for fmt in set(cache_format(entryno) for entryno, _ in numbered):
+                rowids = [entry.rowid for entryno, entry in numbered
+                          if entry.rowid is not None and cache_format(entryno) == fmt]
+                for rowid, text in db.get_rendered(rowids, fmt, use_original_key).items():
+                    cached[rowid, fmt] = text
+
+        new_renderings = []
+        hits = 0
+        for entryno, entry in numbered:
+            fmt = cache_format(entryno)
+            text = cached.get((entry.rowid, fmt))
+            if text is None:
+                placeholder = '#' * len(str(entryno))
+                text = render_entry(entry, output_format, use_original_key, placeholder)
+                if entry.rowid is not None:
+                    new_renderings.append((entry.rowid, fmt, use_original_key, text))
             else:
-                raise ValueError("Unknown output format: %s" % output_format)
+                hits += 1
+            if output_format == 'txt':
+                text = str(entryno) + text[len(str(entryno)):]
+            yield text
+
+        if db is not None:
+            db.store_rendered(new_renderings)
+            db.increment_stat("render_cache_hits", hits)
+            db.increment_stat("render_cache_misses", len(numbered) - hits)
+
+    chunk = []
+    entryno = 1
+    previous = None
+    for entry in results:
+        chunk.append(entry)
+        if len(chunk) == chunk_size:
+            for text in format_chunk(chunk, entryno):
+                if previous is not None:
+                    yield previous
+                previous = text
+            entryno += len(chunk)
+            chunk = []
+    for text in format_chunk(chunk, entryno):
+        if previous is not None:
+            yield previous
+        previous = text
+    if previous is not None:
+        yield previous[:-1] # Remove the last empty line
+
+    if db is not None:
+        db.save()
+
+
+def format_search_results(results: List[BibEntry],
+                          output_format: str,
+                          use_original_key=False,
+                          db: BibDB = None) -> str:
+    """
+    Formats a set of entries for printing to the terminal.
+    Output can be either actual BibTeX or a summarized form.
+    The summaries are built from the fields stored in the database, without
+    parsing the BibTeX.
 
-    return output[:-1] # Remove the last empty line
+    :param results: A list of BibEntry objects.
+    :param output_format: One of OUTPUT_FORMATS.
+    :param use_original_key: Whether to use the default key instead of the custom one.
+    :param db: The database used for caching renderings, if any.
+    :return: An amalgamated string including all entries.
+    """
+    return "".join(iter_formatted_results(results, output_format, use_original_key, db))
 
 def _get_cache_or_search_result(db: BibDB,
-                                search_terms: List[str]) -> Tuple[str, str]:
+                                search_terms: List[str]) -> BibEntry:
     """
     If search_terms is empty or a single digit, return that item from
     the cache. Otherwise, return the first item from the search results.
-    Item returned is a tuple (bibtex_str, custom_key).
     """
     if len(search_terms) == 0:
-        # load the search cache, use first entry
-        results = db.load_search_cache()
-        if not results:
-            logging.error("No documents found in search cache.")
-            sys.exit(1)
-
+        # use the first entry of the search cache
         entry_index = 0
 
     elif len(search_terms) == 1 and re.match(r'\d+', search_terms[0]) is not None:
-        # load the search cache, use specified entry
-        results = db.load_search_cache()
-        if not results:
-            logging.error("No documents found in search cache.")
-            sys.exit(1)
-
+        # use the specified entry of the search cache
         entry_index = int(search_terms[0]) - 1
 
     else:
-        results = db.search(search_terms)
-        if not results:
+        # The search cache is filled before the first result is returned
+        result = next(db.iter_search(search_terms), None)
+        if result is None:
             logging.error("Search returned no results.")
             sys.exit(1)
+        return result
 
-        entry_index = 0
-
-    if entry_index >= len(results):
-        logging.error("You requested result {}, but only {} documents were found.".format(entry_index, len(results)))
+    result = db.get_search_cache_entry(entry_index + 1)
+    if result is None:
+        cache_size = db.search_cache_size()
+        if cache_size == 0:
+            logging.error("No documents found in search cache.")
+        elif entry_index < cache_size:
+            logging.error("Result {} has been removed from the database since the search.".format(entry_index + 1))
+        else:
+            logging.error("You requested result {}, but only {} documents were found.".format(entry_index + 1, cache_size))
         sys.exit(1)
 
-    return results[entry_index]
+    return result
+
 
+@functools.lru_cache(maxsize=None)
+def _get_db(config) -> BibDB:
+    """
+    Opens the database for a config. The connection is shared, so that
+    `bibsearch serve` keeps it open between requests.
+    """
+    return BibDB(config)
 
 def _find(args, config):
-    db = BibDB(config)
-    results = db.search(args.terms)
+    db = _get_db(config)
+    results = db.iter_search(args.terms, args.limit, args.offset, args.fuzzy, args.body)
     # -o takes priority over --bibtex, --bibtex over config default
     if args.output_format is not None:
         output_format = args.output_format
@@ -250,7 +401,8 @@ def _find(args, config):
         output_format = "bib"
     else:
         output_format = config.default_output_format
-    print(format_search_results(results, output_format, args.original_key), end='')
+    for text in iter_formatted_results(results, output_format, args.original_key, db=db):
+        sys.stdout.write(text)
     #if len(results):
     #    logging.info("Download and display any of these PDFs with 'bibsearch open N' (N the index).")
 
@@ -262,16 +414,23 @@ def _open(args, config):
 
     """
     db = BibDB(config)
-    bibtex, key = _get_cache_or_search_result(db, args.terms)
-
-    entry = bibutils.fulltext_to_single_entry(bibtex)
-    if "url" not in entry.fields:
-        logging.error("Entry does not contain a URL field")
-    else:
-        if not os.path.exists(config.download_dir):
-            os.makedirs(config.download_dir)
-        pdf_path = download_entry(entry, config)
-        subprocess.Popen([config.open_command, pdf_path])
+    result = _get_cache_or_search_result(db, args.terms)
+
+    pdf = db.get_pdfs([result.rowid]).get(result.rowid)
+    if pdf is not None and not os.path.exists(pdf[0]):
+        # Restore the file from the store
+        with contextlib.suppress(OSError):
+            os.link(_pdf_object_path(pdf[2], config), pdf[0])
+    if pdf is None or not os.path.exists(pdf[0]):
+        entry = bibutils.fulltext_to_single_entry(result.fulltext)
+        if "url" not in entry.fields:
+            logging.error("Entry does not contain a URL field")
+            sys.exit(1)
+        pdf = download_entry(entry, config)
+        if result.rowid is not None:
+            db.store_pdfs([(result.rowid,) + pdf])
+            db.save()
+    subprocess.Popen([config.open_command, pdf[0]])
 
 
 def _download(args, config):
@@ -284,98 +443,410 @@ def _download(args, config):
         logging.error("No documents returned by query")
         sys.exit(1)
 
-    if not os.path.exists(config.download_dir):
-        os.makedirs(config.download_dir)
-    iterable = tqdm(results, ncols=80, bar_format="{l_bar}{bar}| [Elapsed: {elapsed} ETA: {remaining}]")
-    for fulltext, _ in iterable:
-        entry = bibutils.fulltext_to_single_entry(fulltext)
-        download_entry(entry, config)
+    pdfs = db.get_pdfs([result.rowid for result in results])
+    downloads = []
+    for result in results:
+        if result.rowid in pdfs and os.path.exists(pdfs[result.rowid][0]):
+            continue
+        entry = bibutils.fulltext_to_single_entry(result.fulltext)
+        if "url" not in entry.fields:
+            logging.warning("Entry %s does not contain a URL field", entry.key)
+            continue
+        downloads.append((result.rowid, entry))
+    if not downloads:
+        logging.info("All files have already been downloaded")
+        return
+
+    import concurrent.futures
+    import threading
+    from tqdm import tqdm
+    from .fetch import Fetcher
+    fetcher = Fetcher.from_config(config)
+    # A single bar for all files, showing the amount of data downloaded
+    progress_bar = tqdm(total=len(downloads), unit="file", ncols=80,
+                        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}{postfix} [Elapsed: {elapsed} ETA: {remaining}]")
+    progress_lock = threading.Lock()
+    downloaded_bytes = 0
+    def progress(size):
+        nonlocal downloaded_bytes
+        with progress_lock:
+            downloaded_bytes += size
+            progress_bar.set_postfix_str("%.1f MB" % (downloaded_bytes / 2**20), refresh=False)
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(int(config.download_connections)) as executor:
+        futures = {executor.submit(download_entry, entry, config, fetcher, progress): (rowid, entry)
+                   for rowid, entry in downloads}
+        for future in concurrent.futures.as_completed(futures):
+            rowid, entry = futures[future]
+            try:
+                db.store_pdfs([(rowid,) + future.result()])
+            except Exception as e:
+                progress_bar.write("Error downloading '%s' [%s]" % (entry.fields["url"], e))
+                failed += 1
+            progress_bar.update()
+    progress_bar.close()
+    db.save()
+    if failed:
+        logging.error("%d of %d files could not be downloaded; interrupted downloads are resumed when running the command again",
+                      failed, len(downloads))
+        sys.exit(1)
+
+
+def _gc(args, config):
+    """
+    Deletes the PDFs of removed entries, and the stored PDFs no longer used
+    by any entry.
+    """
+    db = BibDB(config)
+    removed = 0
+    reclaimed = 0
+    def remove(fname):
+        nonlocal removed, reclaimed
+        stat = os.stat(fname)
+        # Space is only reclaimed once all the links to a file are gone
+        if stat.st_nlink == 1:
+            reclaimed += stat.st_size
+        os.remove(fname)
+        removed += 1
+
+    orphans = [path for path, _ in db.orphaned_pdfs()]
+    for path in orphans:
+        if os.path.exists(path):
+            remove(path)
+    db.remove_pdfs(orphans)
+    db.save()
+    used = db.pdf_checksums()
+    for dirpath, _, fnames in os.walk(os.path.join(config.download_dir, "objects")):
+        for fname in fnames:
+            sha256, extension = os.path.splitext(fname)
+            if extension == ".pdf" and sha256 not in used:
+                remove(os.path.join(dirpath, fname))
+    logging.info("Removed %d files, reclaiming %.1f MB", removed, reclaimed / 2**20)
+
+
+def extract_text(pdf_path: str, config) -> str:
+    """
+    Extracts the text of a PDF with the pdftotext_command of the config.
+    """
+    process = subprocess.run([config.pdftotext_command, "-enc", "UTF-8", pdf_path, "-"],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise BibsearchError(process.stderr.decode("utf-8", errors="replace").strip()
+                             or "%s exited with status %d" % (config.pdftotext_command, process.returncode))
+    return process.stdout.decode("utf-8", errors="replace")
+
+
+def _index(args, config):
+    """
+    Indexes the text of the downloaded PDFs that are new or have changed
+    since they were last indexed, for `find --body`.
+    """
+    import shutil
+    db = BibDB(config)
+    if not db.has_fts:
+        logging.error("Searching the text of papers requires FTS5 support in sqlite3")
+        sys.exit(1)
+    if shutil.which(config.pdftotext_command) is None:
+        logging.error("'%s' was not found, it is needed for extracting the text of PDFs "
+                      "(see pdftotext_command in the config file)", config.pdftotext_command)
+        sys.exit(1)
+
+    changed = []
+    pending = []
+    for rowid, path, size, sha256, mtime, indexed_sha256 in db.pdfs_to_index():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime) != (size, mtime):
+            # Modified since it was downloaded
+            _, size, sha256, mtime = store_pdf(path, config)
+            changed.append((rowid, path, size, sha256, mtime))
+        if sha256 != indexed_sha256:
+            pending.append((rowid, path, sha256))
+    db.store_pdfs(changed)
+    db.save()
+    if not pending:
+        logging.info("All downloaded papers are already indexed")
+        return
+
+    import concurrent.futures
+    from tqdm import tqdm
+    # Each extraction runs in its own process
+    jobs = args.jobs or os.cpu_count() or 1
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor, \
+         tqdm(total=len(pending), unit="file", ncols=80,
+              bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [Elapsed: {elapsed} ETA: {remaining}]") as progress_bar:
+        futures = {executor.submit(extract_text, path, config): (rowid, path, sha256)
+                   for rowid, path, sha256 in pending}
+        for future in concurrent.futures.as_completed(futures):
+            rowid, path, sha256 = futures[future]
+            try:
+                db.store_body(rowid, sha256, future.result())
+            except Exception as e:
+                progress_bar.write("Error extracting the text of '%s' [%s]" % (path, e))
+                failed += 1
+            progress_bar.update()
+            # Keep what is done if interrupted
+            if progress_bar.n % 100 == 0:
+                db.save()
+    db.save()
+    if failed:
+        logging.error("The text of %d of %d files could not be extracted", failed, len(pending))
+        sys.exit(1)
 
 
 class AddFileError(BibsearchError):
     pass
 
-def _add_file(fname, force_redownload, db, per_file_progress_bar):
+def _download_bib(fname, fetcher, known=None):
     """
-    Return #added, #skipped, file_skipped, warnings
+    Downloads a BibTeX file. If the information stored about a previous
+    download is given (see BibDB.get_downloaded_file), the request is
+    conditional, and the file is considered unchanged if the server says so
+    or if its contents have the same checksum as before.
+
+    :return: A tuple (text, file_info). The text is None if the file did not
+             change. file_info is to be stored with BibDB.register_file_downloaded.
     """
-    if fname.startswith('http'):
-        if not force_redownload and db.file_has_been_downloaded(fname): 
-            return 0, 0, True, []
-        try:
-            new_entries = pybtex.parse_string(download_file(fname),
-                                              bib_format="bibtex").entries
-        except urllib.error.URLError as e:
+    import urllib.error
+    known = known or {}
+    try:
+        content, etag, last_modified = fetcher.fetch_if_modified(fname,
+                                                                 known.get("etag"),
+                                                                 known.get("last_modified"))
+    except urllib.error.URLError as e:
+        raise AddFileError("Error downloading '%s' [%s]" % (fname, str(e)))
+    if content is None:
+        return None, known
+    file_info = dict(etag=etag,
+                     last_modified=last_modified,
+                     size=len(content),
+                     sha256=hashlib.sha256(content).hexdigest())
+    if file_info["sha256"] == known.get("sha256"):
+        return None, file_info
+    if fname.endswith(".gz"):
+        content = gzip.decompress(content)
+    return content.decode("utf-8"), file_info
+
+def _parse_stream(fname, stream):
+    import pybtex.database as pybtex
+    try:
+        yield from bibutils.iter_bibtex_entries(stream)
+    except pybtex.PybtexError:
+        raise AddFileError("Error parsing file %s" % fname)
+
+def _read_entries(fname, text=None):
+    """
+    Parses a BibTeX file one entry at a time.
+
+    :param text: The contents of the file, for downloaded files.
+    :return: A generator over the pybtex entries.
+    """
+    if text is not None:
+        yield from _parse_stream(fname, io.StringIO(text))
+    else:
+        open_file = gzip.open if fname.endswith(".gz") else open
+        with open_file(fname, "rt", encoding="utf-8") as f:
+            yield from _parse_stream(fname, f)
+
+class _HashingReader(io.RawIOBase):
+    """Computes the size and checksum of the data read from a binary stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.size += len(data)
+        self.sha256.update(data)
+        return len(data)
+
+def _conditional_headers(known):
+    headers = {}
+    if known and known.get("etag"):
+        headers["If-None-Match"] = known["etag"]
+    if known and known.get("last_modified"):
+        headers["If-Modified-Since"] = known["last_modified"]
+    return headers
+
+def _stream_download(fname, fetcher, known, file_info):
+    """
+    Parses a BibTeX file while it is being downloaded, so that neither the
+    file nor its parsed form need to be kept in memory.
+
+    If the checksum of a previous download is known, the file is instead
+    buffered in a temporary file and only parsed if its checksum changed, as
+    servers ignoring conditional requests send unchanged files again.
+
+    :param known: Information about a previous download, for conditional requests.
+    :param file_info: A dict which is filled with the information to be stored
+                      with BibDB.register_file_downloaded once the download is
+                      complete. If the file did not change, "unchanged" is set.
+    :return: A generator over the pybtex entries.
+    """
+    import urllib.error
+    def text_stream(stream):
+        if fname.endswith(".gz"):
+            stream = gzip.GzipFile(fileobj=stream)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    try:
+        if known and known.get("sha256"):
+            import shutil
+            with tempfile.TemporaryFile() as buffered:
+                with fetcher.open(fname, _conditional_headers(known)) as response:
+                    file_info.update(etag=response.headers.get("ETag"),
+                                     last_modified=response.headers.get("Last-Modified"))
+                    reader = _HashingReader(response)
+                    shutil.copyfileobj(reader, buffered)
+                file_info.update(size=reader.size, sha256=reader.sha256.hexdigest())
+                if file_info["sha256"] == known["sha256"]:
+                    file_info["unchanged"] = True
+                    return
+                buffered.seek(0)
+                yield from _parse_stream(fname, text_stream(buffered))
+            return
+        with fetcher.open(fname, _conditional_headers(known)) as response:
+            file_info.update(etag=response.headers.get("ETag"),
+                             last_modified=response.headers.get("Last-Modified"))
+            reader = _HashingReader(response)
+            yield from _parse_stream(fname, text_stream(io.BufferedReader(reader)))
+            file_info.update(size=reader.size, sha256=reader.sha256.hexdigest())
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
             raise AddFileError("Error downloading '%s' [%s]" % (fname, str(e)))
-        except pybtex.PybtexError:
-            raise AddFileError("Error parsing file %s" % fname)
-        db.register_file_downloaded(fname)
+        file_info.update(known, unchanged=True)
+    except (urllib.error.URLError, OSError) as e:
+        raise AddFileError("Error downloading '%s' [%s]" % (fname, str(e)))
+
+def _load_file_rows(fname, text=None):
+    """
+    Runs in a worker process: parses a file and prepares all its entries
+    for insertion (see bibutils.prepare_entry), so that the main process
+    only needs to write them to the database.
+    """
+    return [bibutils.prepare_entry(entry) for entry in _read_entries(fname, text) if entry.key]
+
+def _load_file(fname, fetcher, executor=None, known=None):
+    """
+    Downloads the file if it is a URL and, if a process pool is given, has it
+    parsed there. This is usually run in the loader thread pool.
+
+    :param known: Information about a previous download, for conditional requests.
+    :return: A tuple (changed, text, rows, file_info). text and rows can be None.
+    """
+    text, file_info = None, None
+    if fname.startswith('http'):
+        text, file_info = _download_bib(fname, fetcher, known)
+        if text is None:
+            return False, None, None, file_info
+    if executor is not None:
+        return True, None, executor.submit(_load_file_rows, fname, text).result(), file_info
+    return True, text, None, file_info
+
+def _file_already_downloaded(fname, force_redownload, db):
+    return fname.startswith('http') and not force_redownload and db.file_has_been_downloaded(fname)
+
+def _add_file(fname, force_redownload, db, per_file_progress_bar, fetcher, pending=None, known=None):
+    """
+    Return #added, #skipped, file_skipped, warnings
+
+    If given, pending is a future holding the result of _load_file for this
+    file, and known the information about a previous download of the file.
+    """
+    if _file_already_downloaded(fname, force_redownload, db):
+        return 0, 0, True, []
+    file_info = None
+    add = db.add
+    if pending is not None:
+        changed, text, rows, file_info = pending.result()
+        if not changed:
+            file_info = dict(file_info, unchanged=True)
+            new_entries = []
+        elif rows is not None:
+            new_entries = rows
+            add = db.add_prepared
+        else:
+            new_entries = _read_entries(fname, text)
+    elif fname.startswith('http'):
+        file_info = {}
+        new_entries = _stream_download(fname, fetcher, known, file_info)
     else:
-        new_entries = pybtex.parse_file(fname,
-                                        bib_format="bibtex").entries
+        new_entries = _read_entries(fname)
 
     added = 0
     skipped = 0
     if per_file_progress_bar:
-        iterable = tqdm(new_entries.values(), ncols=80, bar_format="{l_bar}{bar}| [Elapsed: {elapsed} ETA: {remaining}]")
+        from tqdm import tqdm
+        if isinstance(new_entries, list):
+            iterable = tqdm(new_entries, ncols=80, bar_format="{l_bar}{bar}| [Elapsed: {elapsed} ETA: {remaining}]")
+        else:
+            # Entries are parsed as they are read, the total is unknown
+            iterable = tqdm(new_entries, ncols=80, bar_format="{n_fmt} entries [Elapsed: {elapsed}, {rate_fmt}]", unit="entries")
     else:
-        iterable = new_entries.values()
+        iterable = new_entries
     all_warnings = []
     for entry in iterable:
-        success, warnings = db.add(entry)
+        success, warnings = add(entry)
         if success:
             added += 1
         else:
             skipped += 1
         all_warnings += warnings
 
+    if file_info is not None:
+        unchanged = file_info.pop("unchanged", False)
+        db.register_file_downloaded(fname, **file_info)
+        if unchanged:
+            return 0, 0, True, []
+
     return added, skipped, False, all_warnings
 
-def get_fnames_from_bibset(raw_fname, database_url):
-    bib_spec = raw_fname[len(BIBSETPREFIX):].strip()
+def get_fnames_from_bibset(raw_fname, config):
+    from .catalog import Catalog
+    bib_spec = raw_fname[len(BIBSETPREFIX):].strip().strip('/')
     spec_fields = bib_spec.split('/')
-    resource = spec_fields[0]
-    if resource == "list":
-        # Special case, list know resources
+    catalog = Catalog(config)
+    if spec_fields[0] == "list":
         textwrapper = textwrap.TextWrapper(subsequent_indent=10*" ")
-        known_resources = download_file(database_url + "list.txt")
-        for l in known_resources.split("\n"):
-            line = l.strip()
-            if line:
-                name, description = line.split("\t")
+        if len(spec_fields) == 1:
+            # Special case, list known resources
+            for name, description in catalog.resources():
                 print("\n".join(textwrapper.wrap("%-10s%s" % (name, description))))
+        else:
+            # Browse the branches of a resource, or its files at the bottom
+            children = catalog.children(spec_fields[1:])
+            for name, count in children:
+                print("\n".join(textwrapper.wrap("%-10s%d file%s" % (name, count, "s" if count != 1 else ""))))
+            if not children:
+                for fname in catalog.files(spec_fields[1:]):
+                    print(fname)
         return []
-    uri = database_url + resource + '.yml'
-    try:
-        currentSet = yaml.load(download_file(uri))
-        #~ currentSet = yaml.load(open("resources/" + resource + ".yml")) # for local testing
-    except urllib.error.URLError as e:
-        logging.error("Could not load resource %s from %s", resource, uri)
-        logging.error('Maybe your connection is down?')
+    fnames = catalog.files(spec_fields)
+    if not fnames:
+        logging.error("Invalid bib specification '%s'", raw_fname)
+        for depth in range(len(spec_fields) - 1, 0, -1):
+            options = catalog.children(spec_fields[:depth])
+            if options:
+                logging.error("Options for '%s' are: %s", "/".join(spec_fields[:depth]),
+                              ", ".join(name for name, _ in options))
+                break
         sys.exit(1)
-    if len(spec_fields) > 1:
-        for f in spec_fields[1:]:
-            # some keys are integers (years)
-            try:
-                currentSet = currentSet[f]
-            except KeyError:
-                logging.error("Invalid branch '%s' in bib specification '%s'",
-                              f, raw_fname)
-                logging.error("Options at this level are:", ', '.join(currentSet.keys()))
-                sys.exit(1)
-    def rec_extract_bib(dict_or_list):
-        result = []
-        if isinstance(dict_or_list, list):
-            result = [fname for fname in dict_or_list]
-        else:
-            for v in dict_or_list.values():
-                result += rec_extract_bib(v)
-        return result
-    return rec_extract_bib(currentSet)
+    return fnames
 
 
 def _arxiv(args, config):
     import feedparser
+    import pybtex.database as pybtex
+    import urllib.parse
+    import urllib.request
 
     db = BibDB(config)
 
@@ -439,7 +910,7 @@ def _arxiv(args, config):
             db.add(bib_entry)
             print_key = bib_entry.key
 
-        results.append((bibutils.single_entry_to_fulltext(bib_entry), print_key))
+        results.append(BibEntry.from_pybtex(bib_entry, print_key))
 
     # Save the results to the search cache
     db.save_to_search_cache(results)
@@ -465,8 +936,8 @@ def _remove(args, config):
     confirmation = 'yes' if args.force else prompt("Do you want to proced with the deletion?", "yes", "NO",
                                                    default=1)
     if confirmation == "yes":
-        for (_, original_key) in search_results:
-            db.remove(original_key)
+        for entry in search_results:
+            db.remove(entry.key)
         db.save()
         print("Removed %d entries." % len(search_results))
     else:
@@ -474,25 +945,89 @@ def _remove(args, config):
 
 
 def _add(args, config):
+    """
+    Adds files to the database. Also used for the 'sync' command, which
+    re-downloads known files with conditional requests and only adds the
+    entries of those that changed.
+    """
     db = BibDB(config)
 
-    for raw_fname in args.files:
-        fnames = [raw_fname] if not raw_fname.startswith(BIBSETPREFIX) \
-                             else get_fnames_from_bibset(raw_fname, config.database_url)
-        added = 0
-        skipped = 0
-        n_files_skipped = 0
+    if args.files:
+        sources = ((raw_fname, [raw_fname] if not raw_fname.startswith(BIBSETPREFIX) \
+                                           else get_fnames_from_bibset(raw_fname, config))
+                   for raw_fname in args.files)
+    else:
+        # 'sync' without arguments checks all the files downloaded so far
+        sources = [("downloaded files", db.downloaded_files())]
+
+    start_time = time.time()
+    with db.bulk_import():
+        added, skipped, n_files_skipped, warning_msgs, error_msgs = _add_all(args, config, db, sources)
+    db.save()
+    elapsed = time.time() - start_time
+
+    if warning_msgs:
+        print("\nDuring operation following warnings occured:")
+        for m in warning_msgs:
+            logging.warning(m)
+    if error_msgs:
+        print("\nDuring operation following errors occured:")
+        for m in error_msgs:
+            logging.error(m)
+    print('\nAdded', added, 'entries, skipped', skipped, 'duplicates. Skipped', n_files_skipped, 'files')
+    if added:
+        print('Imported %.1f entries/s' % (added / max(elapsed, 1e-6)))
+
+def _add_all(args, config, db, sources):
+    """
+    Adds all the files given as (description, list of files) pairs.
+    Return #added, #skipped, #files_skipped, warnings, errors
+    """
+    added = 0
+    skipped = 0
+    n_files_skipped = 0
+    error_msgs = []
+    warning_msgs = []
+    # Files are downloaded (and parsed, if there are several jobs) ahead in
+    # a pool of loader threads, while the main thread adds them to the database
+    import concurrent.futures
+    from tqdm import tqdm
+    from .fetch import Fetcher
+    fetcher = Fetcher.from_config(config)
+    executor = None
+    if args.jobs > 1:
+        import multiprocessing
+        # The workers are started on the first submit from a loader thread,
+        # and forking a process with running threads can deadlock the child
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        executor = concurrent.futures.ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context(method))
+    n_ahead = max(int(config.download_connections), 2 * args.jobs)
+    loader = concurrent.futures.ThreadPoolExecutor(n_ahead)
+    for raw_fname, fnames in sources:
+        # Files to be loaded ahead, in order
+        to_load = iter([f for f in dict.fromkeys(fnames)
+                        if not _file_already_downloaded(f, args.redownload, db)])
+        pending = {}
         if len(fnames) > 1:
             iterable = tqdm(fnames, ncols=80, bar_format="Adding %s {l_bar}{bar}| [Elapsed: {elapsed} ETA: {remaining}]" % raw_fname)
             per_file_progress_bar = False
         else:
             iterable = fnames
             per_file_progress_bar = True
-        error_msgs = []
-        warning_msgs = []
         for f in iterable:
+            if len(fnames) > 1:
+                # Keep the loaders busy, but bound the number of files waiting
+                # in memory
+                while len(pending) < n_ahead:
+                    next_fname = next(to_load, None)
+                    if next_fname is None:
+                        break
+                    pending[next_fname] = loader.submit(_load_file, next_fname, fetcher, executor,
+                                                        db.get_downloaded_file(next_fname) if args.sync else None)
             try:
-                f_added, f_skipped, file_skipped, file_warnings = _add_file(f, args.redownload, db, per_file_progress_bar)
+                f_added, f_skipped, file_skipped, file_warnings = _add_file(f, args.redownload, db, per_file_progress_bar,
+                                                                            fetcher, pending.pop(f, None),
+                                                                            db.get_downloaded_file(f) if args.sync else None)
                 if args.verbose and not per_file_progress_bar:
                     if not file_skipped:
                         log_msg = "Added %d entries from %s" % (f_added, f)
@@ -509,55 +1044,278 @@ def _add(args, config):
             skipped += f_skipped
             if file_skipped:
                 n_files_skipped += 1
+    loader.shutdown()
+    if executor is not None:
+        executor.shutdown()
 
-    db.save()
-
-    if warning_msgs:
-        print("\nDuring operation following warnings occured:")
-        for m in warning_msgs:
-            logging.warning(m)
-    if error_msgs:
-        print("\nDuring operation following errors occured:")
-        for m in error_msgs:
-            logging.error(m)
-    print('\nAdded', added, 'entries, skipped', skipped, 'duplicates. Skipped', n_files_skipped, 'files')
+    return added, skipped, n_files_skipped, warning_msgs, error_msgs
 
 def _print(args, config):
     db = BibDB(config)
     if args.summary:
         print('Database has', len(db), 'entries')
+        hits = db.get_stat("render_cache_hits")
+        misses = db.get_stat("render_cache_misses")
+        if hits + misses:
+            print('Rendered output cache: {} hits, {} misses ({:.1f}% hit rate)'.format(
+                hits, misses, 100 * hits / (hits + misses)))
     else:
         for entry in db:
             print(entry.rstrip() + "\n")
 
-def _tex(args, config):
+def _read_aux(aux_fname):
+    """
+    Reads the citations of an .aux file, following the .aux files of
+    \\include'd documents.
+
+    :return: A tuple (keys, bibdata, fnames), with the cited keys in order of
+             first citation, the argument of \\bibdata (or None) and the
+             .aux files read.
+    """
     citation_re = re.compile(r'\\citation{(.*)}')
     bibdata_re = re.compile(r'\\bibdata{(.*)}')
-    db = BibDB(config)
-    aux_fname = args.file
-    if not aux_fname.endswith(".aux"):
-        if aux_fname.endswith(".tex"):
-            aux_fname = aux_fname[:-4] + ".aux"
+    input_re = re.compile(r'\\@input{(.*)}')
+    keys = collections.OrderedDict()
+    bibdata = None
+    fnames = []
+    def read(fname):
+        nonlocal bibdata
+        fnames.append(fname)
+        with open(fname) as fp:
+            for l in fp:
+                match = citation_re.match(l)
+                if match:
+                    for key in match.group(1).split(','):
+                        keys[key] = None
+                    continue
+                match = bibdata_re.match(l)
+                if match:
+                    bibdata = match.group(1)
+                    continue
+                match = input_re.match(l)
+                if match:
+                    # Relative to the main .aux file, like LaTeX does
+                    included_fname = os.path.join(os.path.dirname(aux_fname), match.group(1))
+                    if os.path.exists(included_fname) and included_fname not in fnames:
+                        read(included_fname)
+    read(aux_fname)
+    return list(keys), bibdata, fnames
+
+# The citation commands of LaTeX, natbib and biblatex, whose mandatory
+# argument is a list of keys. Other commands with "cite" in their name are
+# not citations, e.g. \citestyle{nature} or \defcitealias{key}{text}.
+_TEX_CITE_COMMANDS = [
+    "cite", "nocite",
+    # natbib
+    "citet", "citep", "citealt", "citealp", "citeauthor", "citefullauthor", "citeyear", "citeyearpar",
+    "citenum", "citetalias", "citepalias",
+    # biblatex
+    "parencite", "footcite", "footcitetext", "textcite", "smartcite", "supercite", "autocite", "citetitle",
+    "citedate", "citeurl", "fullcite", "footfullcite", "volcite", "pvolcite", "fvolcite", "ftvolcite",
+    "svolcite", "tvolcite", "avolcite", "notecite", "pnotecite", "fnotecite",
+    # biblatex's multicite commands
+    "cites", "parencites", "footcites", "footcitetexts", "smartcites", "textcites", "supercites", "autocites",
+]
+# Commands of a .tex file relevant for the bibliography, with their
+# mandatory argument. natbib and biblatex also have capitalised variants of
+# the citation commands, e.g. \Citet
+_tex_command_re = re.compile(r"""
+    \\(?P<command>(?:%s|input|include|bibliography|addbibresource)(?![a-zA-Z]))\*?
+    \s*(?:\[[^\]]*\]\s*)*          # Optional arguments
+    \{(?P<argument>[^}]*)\}""" % "|".join(_TEX_CITE_COMMANDS + [c[0].upper() + c[1:] for c in _TEX_CITE_COMMANDS]),
+    re.VERBOSE)
+# Further arguments of biblatex's multicite commands, e.g. \cites{a}{b}
+_tex_extra_argument_re = re.compile(r'\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}')
+_tex_comment_re = re.compile(r'(?<!\\)%.*')
+
+def _scan_tex_file(fname):
+    """
+    Returns the citations, included files and bibliographies of a .tex
+    file, as ("cite", key), ("input", name) and ("bibdata", name) tuples in
+    order of appearance.
+    """
+    with open(fname, encoding="utf-8", errors="replace") as fp:
+        text = _tex_comment_re.sub("", fp.read())
+    items = []
+    for match in _tex_command_re.finditer(text):
+        command, argument = match.group("command", "argument")
+        if "cite" in command.lower():
+            arguments = [argument]
+            if command.lower().endswith("cites"):
+                position = match.end()
+                extra_argument = _tex_extra_argument_re.match(text, position)
+                while extra_argument:
+                    arguments.append(extra_argument.group(1))
+                    extra_argument = _tex_extra_argument_re.match(text, extra_argument.end())
+            for argument in arguments:
+                for key in argument.split(","):
+                    key = key.strip()
+                    # \nocite{*} adds the whole bib file, which we cannot do
+                    if key and key != "*":
+                        items.append(("cite", key))
+        elif command in ("input", "include"):
+            items.append(("input", argument.strip()))
         else:
-            aux_fname = aux_fname + ".aux"
+            bibdata = argument.strip()
+            if bibdata.endswith(".bib"):
+                bibdata = bibdata[:-4]
+            items.append(("bibdata", bibdata))
+    return items
+
+def _scan_tex(tex_fname, max_workers=8):
+    """
+    Reads the citations of a .tex file and of the files it includes with
+    \\input and \\include, without needing LaTeX to have been run. The files
+    are read in parallel as they are discovered.
+
+    :return: A tuple (keys, bibdata, fnames) like _read_aux, with the .tex
+             files read.
+    """
+    import concurrent.futures
+
+    def included_fname(name):
+        # Relative to the main file, like LaTeX does when run from its directory
+        fname = os.path.join(os.path.dirname(tex_fname), name)
+        if not fname.endswith(".tex") and not os.path.exists(fname):
+            fname += ".tex"
+        return fname
+
+    scanned = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_scan_tex_file, tex_fname): tex_fname}
+        submitted = {tex_fname}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                fname = pending.pop(future)
+                try:
+                    scanned[fname] = future.result()
+                except OSError as e:
+                    if fname == tex_fname:
+                        raise
+                    logging.warning("Could not read %s: %s", fname, e)
+                    continue
+                for kind, value in scanned[fname]:
+                    if kind == "input" and included_fname(value) not in submitted:
+                        submitted.add(included_fname(value))
+                        pending[executor.submit(_scan_tex_file, included_fname(value))] = included_fname(value)
+
+    # The citations are collected in document order, with the included files
+    # at the place where they are included
+    keys = collections.OrderedDict()
+    bibdata = None
+    fnames = []
+    def walk(fname):
+        nonlocal bibdata
+        fnames.append(fname)
+        for kind, value in scanned.get(fname, []):
+            if kind == "cite":
+                keys[value] = None
+            elif kind == "input":
+                if included_fname(value) not in fnames:
+                    walk(included_fname(value))
+            elif bibdata is None:
+                bibdata = value
+    walk(tex_fname)
+    return list(keys), bibdata, fnames
+
+def _write_if_changed(fname, text) -> bool:
+    """
+    Replaces the contents of a file atomically, unless they are already
+    the given text, so that tools watching the file (e.g. latexmk) do not
+    see a change.
+
+    :return: Whether the file was written.
+    """
+    try:
+        with open(fname) as fp:
+            if fp.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    temp_fname = fname + ".tmp"
+    with open(temp_fname, "w") as fp:
+        fp.write(text)
+    os.replace(temp_fname, fname)
+    return True
+
+def _watch_files(fnames, interval=0.5):
+    """
+    Yields whenever one of the files has been written. Uses inotify if the
+    inotify_simple package is installed, and otherwise polls the files
+    every interval seconds, waiting until they stop changing. The list of
+    files may be changed by the caller between iterations.
+    """
+    def signatures():
+        result = {}
+        for fname in fnames:
+            try:
+                stat = os.stat(fname)
+                result[fname] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                result[fname] = None
+        return result
+
+    try:
+        import inotify_simple
+        inotify = inotify_simple.INotify()
+    except (ImportError, OSError):
+        logging.debug("inotify not available, polling for changes")
+        inotify = None
+    watched_dirs = {}
+    last_signatures = signatures()
+    while True:
+        if inotify is not None:
+            for fname in fnames:
+                directory = os.path.dirname(os.path.abspath(fname))
+                if directory not in watched_dirs.values():
+                    # LaTeX writes the .aux files in place, other tools may
+                    # move them into place
+                    watch = inotify.add_watch(directory,
+                                              inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+                    watched_dirs[watch] = directory
+            watched_fnames = set(os.path.abspath(fname) for fname in fnames)
+            if not any(os.path.join(watched_dirs[event.wd], event.name) in watched_fnames
+                       for event in inotify.read()):
+                continue
+        else:
+            time.sleep(interval)
+            current_signatures = signatures()
+            if current_signatures == last_signatures:
+                continue
+            # Wait for the writes to settle
+            while True:
+                time.sleep(interval)
+                last_signatures, current_signatures = current_signatures, signatures()
+                if current_signatures == last_signatures:
+                    break
+        yield
+
+def _tex(args, config):
+    db = _get_db(config)
+    base_fname = args.file
+    if base_fname.endswith(".aux") or base_fname.endswith(".tex"):
+        base_fname = base_fname[:-4]
+    aux_fname = base_fname + ".aux"
+    tex_fname = base_fname + ".tex"
+    scan_tex = args.scan_tex
+    if not scan_tex and not os.path.exists(aux_fname) and os.path.exists(tex_fname):
+        logging.info("%s not found, reading the citations from the .tex files.", aux_fname)
+        scan_tex = True
+    if scan_tex:
+        main_fname = tex_fname
+        read_citations = functools.partial(_scan_tex, tex_fname)
+    else:
+        main_fname = aux_fname
+        read_citations = functools.partial(_read_aux, aux_fname)
+    write_bibfile = args.write_bibfile or args.overwrite_bibfile
+    if args.watch and not write_bibfile:
+        logging.error("--watch needs -b or -B, the bib file is written when the citations change")
+        sys.exit(1)
+    keys, bibdata, citation_fnames = read_citations()
     bibfile = None
-    entries = set()
-    for l in open(aux_fname):
-        match = citation_re.match(l)
-        if match:
-            keystr = match.group(1)
-            for key in keystr.split(','):
-                bib_entry = db.search_key(key)
-                if bib_entry:
-                    entries.add(bib_entry)
-                else:
-                    logging.warning("Entry '%s' not found", key)
-        elif args.write_bibfile or args.overwrite_bibfile:
-            match = bibdata_re.match(l)
-            if match:
-                bibfile = match.group(1)
-    if bibfile:
-        bibfile = os.path.join(os.path.dirname(aux_fname), bibfile+".bib")
+    if bibdata and write_bibfile:
+        bibfile = os.path.join(os.path.dirname(main_fname), bibdata+".bib")
         if os.path.exists(bibfile):
             if args.overwrite_bibfile:
                 logging.info("Overwriting bib file %s.", bibfile)
@@ -566,11 +1324,44 @@ def _tex(args, config):
                 sys.exit(1)
         else:
             logging.info("Writing bib file %s.", bibfile)
-        fp_out = open(bibfile, "w")
+
+    # Entries are resolved once, only keys not found so far are looked up
+    # again when the citations change
+    entries = {}
+    missing = set()
+    def bib_text(keys):
+        new_keys = [key for key in keys if key not in entries]
+        if new_keys:
+            entries.update(db.search_keys(new_keys))
+        for key in new_keys:
+            if key not in entries and key not in missing:
+                logging.warning("Entry '%s' not found", key)
+                missing.add(key)
+        return "".join(entries[key] + "\n\n" for key in keys if key in entries)
+
+    if bibfile:
+        if not _write_if_changed(bibfile, bib_text(keys)):
+            logging.info("Bib file %s is up to date.", bibfile)
     else:
-        fp_out = sys.stdout
-    for e in entries:
-        print(e + "\n", file=fp_out)
+        sys.stdout.write(bib_text(keys))
+    if not args.watch:
+        return
+    if not bibfile:
+        logging.error("No bibliography in %s, nothing to watch for", main_fname)
+        sys.exit(1)
+
+    logging.info("Watching %s for new citations, press Ctrl-C to stop.", main_fname)
+    try:
+        for _ in _watch_files(citation_fnames):
+            try:
+                keys, _, citation_fnames[:] = read_citations()
+            except FileNotFoundError:
+                # Removed by a clean-up, wait for the next change
+                continue
+            if _write_if_changed(bibfile, bib_text(keys)):
+                logging.info("Updated bib file %s (%d entries).", bibfile, sum(key in entries for key in keys))
+    except KeyboardInterrupt:
+        pass
 
 def find_entry(entries_iter, field, value):
     for e in entries_iter:
@@ -594,6 +1385,7 @@ def compare_entries(old, new):
     return added, deleted, edited
 
 def _edit(args, config):
+    import pybtex.database as pybtex
 
     db = BibDB(config)
     results = db.search(args.terms)
@@ -662,11 +1454,98 @@ def _edit(args, config):
     else:
         print("Aborted.")
 
+def _key(args, config):
+    db = _get_db(config)
+    found = False
+    entries = db.search_keys(args.keys)
+    for key in args.keys:
+        if key in entries:
+            print(entries[key])
+            found = True
+        else:
+            logging.warning("Entry '%s' not found", key)
+    if not found:
+        sys.exit(1)
+
+def _complete(args, config):
+    db = _get_db(config)
+    for key, title in db.complete(" ".join(args.partial), args.limit):
+        print("%s\t%s" % (key, title or ""))
+
+def _socket_path(config):
+    return os.path.join(config.bibsearch_dir, "bibsearch.sock")
+
+def _config_mtime(config_file):
+    try:
+        return os.path.getmtime(config_file)
+    except OSError:
+        return None
+
+def _serve(args, config):
+    if not daemon.supported():
+        logging.error("The server requires Unix sockets, which are not available on this system")
+        sys.exit(1)
+    parser = get_parser()
+    _get_db(config)
+    config_file = os.path.abspath(args.config_file)
+    config_mtime = _config_mtime(config_file)
+
+    def run_command(argv, cwd):
+        nonlocal config, config_mtime
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+        log_handler = logging.StreamHandler(stderr)
+        log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root_logger = logging.getLogger()
+        saved_handlers = root_logger.handlers
+        root_logger.handlers = [log_handler]
+        server_cwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                request_args = parser.parse_args(argv)
+                # Commands using another config file are run by the client
+                if os.path.abspath(request_args.config_file) != config_file:
+                    return None
+                # Picks up changes to the config file, reopening the database
+                if _config_mtime(config_file) != config_mtime:
+                    config = Config(config_file)
+                    config_mtime = _config_mtime(config_file)
+                    _get_db.cache_clear()
+                # The client only guesses which commands are served
+                if not _is_served(request_args):
+                    return None
+                request_args.func(request_args, config)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            stderr.write(traceback.format_exc())
+            status = 1
+        finally:
+            # A failed command may leave a write transaction open, which
+            # would keep other processes from writing to the database
+            db = _get_db(config)
+            if db.connection.in_transaction:
+                db.connection.rollback()
+            os.chdir(server_cwd)
+            root_logger.handlers = saved_handlers
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    try:
+        daemon.serve(_socket_path(config), run_command)
+    except RuntimeError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
 def _macros(args, config):
     for macro, expansion in config.macros.items():
         print("%s:\t%s" % (macro, expansion))
 
 def _man(args, config):
+    from pkg_resources import resource_filename, resource_exists
     if not resource_exists('bibsearch', 'manual.1'):
         logging.error("Can't find manual page")
         sys.exit(1)
@@ -683,10 +1562,9 @@ class SubcommandHelpFormatter(argparse.RawDescriptionHelpFormatter):
             parts = "\n".join(parts.split("\n")[1:])
         return parts
 
-def main():
-    logging.basicConfig(level=logging.INFO,
-                        format="[%(levelname)s] %(message)s")
+LOG_FORMAT = "[%(levelname)s] %(message)s"
 
+def get_parser():
     parser = argparse.ArgumentParser(description="bibsearch: Download, manage, and search a BibTeX database.\nUse '%(prog)s man' to get complete help.",
                                      formatter_class=SubcommandHelpFormatter)
     parser.add_argument('--version', '-V', action='version', version='%(prog)s {}'.format(VERSION))
@@ -704,7 +1582,14 @@ def main():
     parser_add.add_argument('files', type=str, default=None, help='BibTeX files to add', nargs='+')
     parser_add.add_argument("-r", "--redownload", help="Re-download already downloaded files", action="store_true")
     parser_add.add_argument("-v", "--verbose", help="Be verbose about which files are being downloaded", action="store_true")
-    parser_add.set_defaults(func=_add)
+    parser_add.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used for parsing files (default: %(default)s)")
+    parser_add.set_defaults(func=_add, sync=False)
+
+    parser_sync = subparsers.add_parser('sync', help='Add the entries of downloaded files that changed since they were added')
+    parser_sync.add_argument('files', type=str, nargs='*', help='URLs or bibspecs to check (default: all downloaded files)')
+    parser_sync.add_argument("-v", "--verbose", help="Be verbose about which files are being downloaded", action="store_true")
+    parser_sync.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used for parsing files (default: %(default)s)")
+    parser_sync.set_defaults(func=_add, sync=True, redownload=True)
 
     parser_arxiv = subparsers.add_parser('arxiv', help='Search the arXiv')
     parser_arxiv.add_argument('query', type=str, nargs='+', default=None, help='Search query')
@@ -721,6 +1606,10 @@ def main():
     parser_find.add_argument('-b', '--bibtex', help='Print entries in bibtex format', action='store_true')
     parser_find.add_argument('--original-key', help='Print the original key of the entries', action='store_true')
     parser_find.add_argument("--output-format", "-f", default=None, choices=OUTPUT_FORMATS, help="Output format. Default: {}".format(Config.get_default('default_output_format')))
+    parser_find.add_argument('-n', '--limit', type=int, default=None, help="Maximum number of results to print")
+    parser_find.add_argument('--offset', type=int, default=0, help="Number of results to skip (default: %(default)s)")
+    parser_find.add_argument('--body', action='store_true', help="Search the text of the downloaded articles instead, see the index command")
+    parser_find.add_argument('--fuzzy', action='store_true', help="Also match words similar to the search terms, e.g. misspelled names")
     parser_find.add_argument('terms', nargs='*', help="One or more search terms which are ANDed together")
     parser_find.set_defaults(func=_find)
 
@@ -732,12 +1621,33 @@ def main():
     parser_download.add_argument('terms', nargs='*', help="One or more search terms which are ANDed together")
     parser_download.set_defaults(func=_download)
 
+    parser_gc = subparsers.add_parser('gc', help='Delete the downloaded articles of removed entries')
+    parser_gc.set_defaults(func=_gc)
+
+    parser_index = subparsers.add_parser('index', help='Index the text of the downloaded articles, for find --body')
+    parser_index.add_argument('-j', '--jobs', type=int, help='Number of files processed in parallel (default: number of CPUs)')
+    parser_index.set_defaults(func=_index)
+
     parser_tex = subparsers.add_parser('tex', help='Create .bib file for a latex article')
     parser_tex.add_argument('file', help='Article file name or .aux file')
     parser_tex.add_argument('-b', '--write-bibfile', help='Autodetect and write bibfile', action='store_true')
     parser_tex.add_argument('-B', '--overwrite-bibfile', help='Autodetect and write bibfile', action='store_true')
+    parser_tex.add_argument('-s', '--scan-tex', help='Read the citations from the .tex files instead of the .aux file', action='store_true')
+    parser_tex.add_argument('-w', '--watch', help='Keep running, updating the bibfile whenever the citations change', action='store_true')
     parser_tex.set_defaults(func=_tex)
 
+    parser_key = subparsers.add_parser('key', help='Print the BibTeX entries with the given keys')
+    parser_key.add_argument('keys', nargs='+', help='Original or custom keys')
+    parser_key.set_defaults(func=_key)
+
+    parser_complete = subparsers.add_parser('complete', help='Complete a partial key or title')
+    parser_complete.add_argument('partial', nargs='+', help='Beginning of a key, or words of a title, the last one possibly incomplete')
+    parser_complete.add_argument('-n', '--limit', type=int, default=10, help='Maximum number of candidates (default: %(default)s)')
+    parser_complete.set_defaults(func=_complete)
+
+    parser_serve = subparsers.add_parser('serve', help='Answer find, key, tex and complete commands from a background process')
+    parser_serve.set_defaults(func=_serve)
+
     parser_edit = subparsers.add_parser('edit', help='Edit entries')
     parser_edit.add_argument('terms', nargs='*', help='One or more search terms')
     parser_edit.set_defaults(func=_edit)
@@ -753,6 +1663,21 @@ def main():
     parser_man = subparsers.add_parser('man', help='Shows documentation in form of a man page', aliases=['help'])
     parser_man.set_defaults(func=_man)
 
+    return parser
+
+# Commands that a running `bibsearch serve` can answer, client.SERVED_COMMANDS
+# lists their names
+SERVED_COMMANDS = (_find, _key, _tex, _complete)
+
+def _is_served(args) -> bool:
+    # Watching would keep the server busy
+    return args.func in SERVED_COMMANDS and not getattr(args, "watch", False)
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format=LOG_FORMAT)
+
+    parser = get_parser()
     args = parser.parse_args()
     config = Config(args.config_file)
     args.func(args, config)
@@ -35,10 +35,16 @@ __all__ = ('Name parse_names ' +
 
 import re
 import collections
+import functools
+import json
 import unicodedata
-import pybtex.database as pybtex
 import string
-import stop_words
+from typing import List, TYPE_CHECKING
+
+# pybtex and stop_words take a while to import, so they are only imported
+# by the functions using them
+if TYPE_CHECKING:
+    import pybtex.database as pybtex
 
 # Control sequences (defined as "control_seq_ilk" in bibtex) and their
 # Unicode translations.  This is similar to, but slightly different
@@ -49,7 +55,7 @@ _CONTROL_SEQS = {
     '\\o': 'ø', '\\O': 'Ø', '\\l': 'ł', '\\L': 'Ł', '\\ss': 'ß'
 }
 
-def single_entry_to_fulltext(entry: pybtex.Entry,
+def single_entry_to_fulltext(entry: "pybtex.Entry",
                              overwrite_key: str = None) -> str:
     """
     Converts a pybtex.Entry to text.
@@ -58,22 +64,125 @@ def single_entry_to_fulltext(entry: pybtex.Entry,
     :param overwrite_key: A key to use instead of the default one.
     :return: A BibTeX entry as text.
     """
+    import pybtex.database as pybtex
     effective_key = entry.key if not overwrite_key else overwrite_key
     formatter = pybtex.BibliographyData(entries={effective_key: entry})
     return formatter.to_string(bib_format="bibtex")
 
-def fulltext_to_single_entry(fulltext: str) -> pybtex.Entry:
+def fulltext_to_single_entry(fulltext: str) -> "pybtex.Entry":
     """
     Parses a BibTeX entry into a pybtex.Entry
     """
+    import pybtex.database as pybtex
     entry, = pybtex.parse_string(fulltext, bib_format="bibtex").entries.values()
     return entry
 
+# Start of a BibTeX command, up to its opening delimiter
+_command_start_re = re.compile(r'@\s*[\w-]*\s*([{(])')
+# A command start that may be completed by reading more data
+_partial_command_start_re = re.compile(r'@\s*[\w-]*\s*\Z')
+_delimiters_re = re.compile(r'[{}()"]')
+def iter_bibtex_chunks(stream, block_size=65536):
+    """
+    Splits the text read from a stream into BibTeX commands (entries,
+    @string definitions, etc.) without reading the whole stream at once.
+    Text between commands is ignored, as BibTeX does.
+
+    :param stream: A text stream, e.g. a file opened in text mode.
+    :param block_size: Number of characters read at once.
+    :return: A generator over the text of each command.
+    """
+    buffer = ""
+    start = None # Start of the current command in the buffer
+    pos = 0 # Scanning position in the buffer
+    depth = 0
+    closing = None
+    # Only tracked outside braces, where a quote starts or ends a value
+    in_quotes = False
+    eof = False
+    while not eof:
+        block = stream.read(block_size)
+        eof = not block
+        # Drop what has already been processed
+        keep_from = start if start is not None else pos
+        buffer = buffer[keep_from:] + block
+        pos -= keep_from
+        if start is not None:
+            start = 0
+        while True:
+            if start is None:
+                at = buffer.find('@', pos)
+                if at < 0:
+                    pos = len(buffer)
+                    break
+                m = _command_start_re.match(buffer, at)
+                if m is None:
+                    if not eof and _partial_command_start_re.match(buffer, at):
+                        # Wait for more data
+                        pos = at
+                        break
+                    pos = at + 1
+                    continue
+                start = at
+                closing = '}' if m.group(1) == '{' else ')'
+                depth = 1 if closing == '}' else 0
+                in_quotes = False
+                pos = m.end()
+            m = None
+            for m in _delimiters_re.finditer(buffer, pos):
+                char = m.group()
+                if char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                    if depth == 0 and closing == '}':
+                        break
+                elif char == '"':
+                    # Quotes inside braces are literal; depth is 0 only
+                    # in commands delimited by parentheses
+                    if depth == 0:
+                        in_quotes = not in_quotes
+                elif char == ')' and closing == ')' and depth == 0 and not in_quotes:
+                    break
+            else:
+                # The command continues in the next block
+                pos = len(buffer)
+                break
+            yield buffer[start:m.end()]
+            start = None
+            pos = m.end()
+    if start is not None and buffer[start:].strip():
+        # Unterminated command, let the parser complain about it
+        yield buffer[start:]
+
+def iter_bibtex_entries(stream, block_size=65536):
+    """
+    Parses a BibTeX stream one entry at a time, so that memory usage does not
+    depend on the size of the input. @string macros are honoured.
+
+    :param stream: A text stream, e.g. a file opened in text mode.
+    :param block_size: Number of characters read at once.
+    :return: A generator over pybtex.Entry objects.
+    """
+    import pybtex.database as pybtex
+    import pybtex.database.input.bibtex as bibtex_input
+    parser = bibtex_input.Parser()
+    for chunk in iter_bibtex_chunks(stream, block_size):
+        # The macros defined so far are kept in the parser, the entries are not
+        parser.data = pybtex.BibliographyData()
+        yield from parser.parse_string(chunk).entries.values()
+
 custom_key_skip_chars = str.maketrans("", "", " `~!@#$%^&*()+=[]{}|\\'\":;,<.>/?")
-custom_key_skip_words = set(stop_words.get_stop_words("en"))
-def generate_custom_key(entry: pybtex.Entry, key_format_in, suffix_level=0):
-    key_format = key_format_in.replace('''{short_year}''', '''{short_year:02d}''')
+@functools.lru_cache(maxsize=None)
+def custom_key_skip_words() -> frozenset:
+    import stop_words
+    return frozenset(stop_words.get_stop_words("en"))
 
+def custom_key_fields(entry: "pybtex.Entry") -> dict:
+    """
+    Extracts the values used for filling the custom key format, except for
+    the suffix, which depends on the contents of the database.
+    """
     # TODO: fault tolerance against missing fields!
     year = int(entry.fields["year"])
     all_authors = entry.persons["author"]
@@ -85,20 +194,169 @@ def generate_custom_key(entry: pybtex.Entry, key_format_in, suffix_level=0):
     #~     .translate(custom_key_skip_chars)
     et_al = "_etAl" if len(all_authors) > 1 else ""
 
-    filtered_title = [w for w in [t.lower() for t in entry.fields["title"].split()] if w not in custom_key_skip_words]
+    filtered_title = [w for w in [t.lower() for t in entry.fields["title"].split()] if w not in custom_key_skip_words()]
     if filtered_title:
         title_word = filtered_title[0]
     else:
         title_word = entry.fields["title"][0]
     title_word = title_word.translate(custom_key_skip_chars)
 
-    return key_format.format(
-        surname=author_surname,
-        et_al=et_al,
-        year=year,
-        short_year=year%100,
-        suffix='' if suffix_level==0 else chr(ord('a') + suffix_level - 1),
-        title=title_word)
+    return dict(surname=author_surname,
+                et_al=et_al,
+                year=year,
+                short_year=year%100,
+                title=title_word)
+
+def custom_key_suffix(suffix_level: int) -> str:
+    """
+    Returns the suffix used for disambiguating custom keys: nothing for
+    level 0, then 'a' to 'z', 'aa', 'ab', and so on.
+    """
+    suffix = ''
+    while suffix_level > 0:
+        suffix_level, remainder = divmod(suffix_level - 1, 26)
+        suffix = chr(ord('a') + remainder) + suffix
+    return suffix
+
+def _format_key(key_fields: dict, key_format_in, suffix):
+    key_format = key_format_in.replace('''{short_year}''', '''{short_year:02d}''')
+    if '{suffix}' not in key_format:
+        # Without a suffix, keys could not be disambiguated
+        key_format += '{suffix}'
+    return key_format.format(suffix=suffix, **key_fields)
+
+def format_custom_key(key_fields: dict, key_format_in, suffix_level=0):
+    return _format_key(key_fields, key_format_in, custom_key_suffix(suffix_level))
+
+def split_custom_key(key_fields: dict, key_format_in):
+    """
+    Formats a custom key without its suffix. Returns the parts of the key
+    before and after the suffix, so that the keys already taken can be
+    looked up by prefix.
+    """
+    prefix, _, tail = _format_key(key_fields, key_format_in, '\0').partition('\0')
+    return prefix, tail
+
+def generate_custom_key(entry: "pybtex.Entry", key_format_in, suffix_level=0):
+    return format_custom_key(custom_key_fields(entry), key_format_in, suffix_level)
+
+entry_key_re = re.compile(r'(@\w+\s*[{(])[^,]*,')
+def replace_entry_key(fulltext: str, key: str) -> str:
+    """
+    Changes the key of a BibTeX entry in text form, without going through
+    pybtex.
+    """
+    return entry_key_re.sub(lambda m: m.group(1) + key + ",", fulltext, count=1)
+
+def entry_to_json(entry: "pybtex.Entry") -> str:
+    """
+    Serializes the type, fields and persons of an entry (as TeX) to JSON,
+    which is much faster to load back than BibTeX.
+    """
+    return json.dumps({"type": entry.type,
+                       "fields": dict(entry.fields),
+                       "persons": {role: [str(person) for person in persons]
+                                   for role, persons in entry.persons.items()}})
+
+def display_fields(entry: "pybtex.Entry") -> tuple:
+    """
+    Returns the author, title and venue of an entry, converted to unicode.
+    """
+    utf_author = authors_to_unicode(entry)
+    utf_title = field_to_unicode(entry, "title")
+    utf_venue = field_to_unicode(entry, "journal")
+    if not utf_venue:
+        utf_venue = field_to_unicode(entry, "booktitle")
+    return utf_author, utf_title, utf_venue
+
+def prepare_entry(entry: "pybtex.Entry") -> tuple:
+    """
+    Computes everything needed for storing an entry in the database, which
+    does not depend on the database contents. The entry is normalized as a
+    side effect (missing authors, "original_key" field).
+
+    :param entry: A pybtex.Entry with a key.
+    :return: A tuple (key, custom key fields, author, title, venue, year,
+             fields, fulltext). The custom key fields are None if they could
+             not be computed, fields is the JSON form of the entry and the
+             fulltext carries the original key.
+    """
+    if not entry.persons.get("author"):
+        import pybtex.database as pybtex
+        entry.persons["author"] = [pybtex.Person("UNKNOWN")]
+
+    original_key = entry.key
+    entry.fields["original_key"] = original_key
+    utf_author, utf_title, utf_venue = display_fields(entry)
+    try:
+        key_fields = custom_key_fields(entry)
+    except Exception:
+        key_fields = None
+    return (original_key,
+            key_fields,
+            utf_author,
+            utf_title,
+            utf_venue,
+            str(entry.fields.get("year")),
+            entry_to_json(entry),
+            single_entry_to_fulltext(entry))
+
+def long_fields(fields: str) -> tuple:
+    """
+    Returns the abstract and keywords of an entry, converted to unicode, from
+    the JSON computed by entry_to_json. Missing fields are None.
+    """
+    if not fields or ('"abstract"' not in fields and '"keywords"' not in fields):
+        # Cheaper than parsing, most entries have neither
+        return None, None
+    entry_fields = json.loads(fields)["fields"]
+    values = []
+    for field in ["abstract", "keywords"]:
+        value = entry_fields.get(field)
+        if value and tex_special_re.search(value):
+            # Not through tex_to_unicode, whose cache is meant for short fields
+            try:
+                value = TeXToUnicode().process(value)
+            except Exception:
+                pass
+        values.append(value)
+    return tuple(values)
+
+def fold(text: str) -> str:
+    """
+    Lowercases a text and removes its diacritics, like the FTS tokenizer
+    does (e.g. "Müller" becomes "muller"). Letters without a decomposition,
+    like "ø", are kept.
+    """
+    if text is None:
+        return None
+    if text.isascii():
+        return text.lower()
+    return unicodedata.normalize("NFC",
+                                 "".join(c for c in unicodedata.normalize("NFD", text.lower())
+                                         if not unicodedata.combining(c)))
+
+_token_re = re.compile(r'[^\W_]+')
+def index_tokens(text: str) -> List[str]:
+    """
+    Splits a text into folded tokens, like the FTS tokenizer does.
+    """
+    return [fold(token) for token in _token_re.findall(text or "")]
+
+def index_words(text: str) -> set:
+    """
+    Returns the folded words of a text. Tokens containing digits are left
+    out.
+    """
+    return set(token for token in index_tokens(text) if token.isalpha())
+
+def trigrams(word: str) -> set:
+    """
+    Returns the trigrams of a word, padded so that its beginning and end
+    get trigrams of their own.
+    """
+    padded = "$%s$" % word
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
 
 def get_author_name(person):
     components = []
@@ -453,16 +711,20 @@ class TeXProcessor:
     def process(self, string):
         """Expand active characters and macros in string.
 
-        Raises InputError if it encounters an active character or
-        macro it doesn't recognize.
+        Unknown active characters and macros are left as they are.
+        The string is scanned once and the output is assembled from
+        pieces, so this is linear in the length of the string.
         """
 
         self.__data = string
         self.__off = 0
+        pieces = []
+        # End of the part of the input already copied to pieces
+        copied = 0
 
         # Process macros
         while True:
-            m = tex_cs_re.search(self.__data, self.__off)
+            m = tex_cs_re.search(string, self.__off)
             if not m:
                 break
             self.__off = m.end()
@@ -470,15 +732,12 @@ class TeXProcessor:
             nval = self._expand(macro)
             if nval is None:
                 continue
-                #~ if macro.startswith('\\'):
-                #~     raise ValueError('unknown macro `{}\''.format(macro))
-                #~ raise ValueError(
-                #~     'unknown special character `{}\''.format(macro))
-            self.__data = self.__data[:m.start()] + nval + \
-                          self.__data[self.__off:]
-            self.__off = m.start() + len(nval)
+            pieces.append(string[copied:m.start()])
+            pieces.append(nval)
+            copied = self.__off
+        pieces.append(string[copied:])
 
-        return self.__data
+        return ''.join(pieces)
 
     def _scan_argument(self):
         """Scan an return a macro argument."""
@@ -571,6 +830,10 @@ class TeXToUnicode(TeXProcessor):
             return unicodedata.normalize('NFC', seq) + rest
         return None
 
+# Strings without any of these are returned unchanged by tex_to_unicode
+tex_special_re = re.compile(r'[\\{}~]|--')
+
+@functools.lru_cache(maxsize=4096)
 def tex_to_unicode(string):
     """Convert a BibTeX field value written in TeX to Unicode.
 
@@ -582,6 +845,11 @@ def tex_to_unicode(string):
     (e.g., purify$ and change.case$) is much more limited than TeX's.
     This implements something closer to TeX on the assumption that the
     goal is to display the string.
+
+    Results are cached, since the same strings (venues, frequent
+    author names) come up over and over.
     """
 
+    if not tex_special_re.search(string):
+        return string
     return TeXToUnicode().process(string)
@@ -0,0 +1,148 @@
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from typing import List
+
+
+class Catalog:
+    """
+    Local index of the bib:// collections, compiled from the catalogs found
+    under database_url: list.txt, describing the collections, and a
+    <collection>.yml file for each of them.
+
+    A file is stored with its path in the YAML tree, i.e. the keys leading
+    to it joined and terminated by "/" (e.g. "acl/acl/2017/"), so that the files
+    under a branch are found with a range scan on the path. Catalogs are
+    downloaded again once they are older than catalog_ttl hours, and the
+    local copy is used if that fails.
+    """
+
+    def __init__(self, config):
+        self.database_url = config.database_url
+        self.ttl = float(config.catalog_ttl) * 3600
+        self.retries = int(config.download_retries)
+        if not os.path.exists(config.bibsearch_dir):
+            os.makedirs(config.bibsearch_dir)
+        self.connection = sqlite3.connect(os.path.join(config.bibsearch_dir, "catalog.db"))
+        self.cursor = self.connection.cursor()
+        self.cursor.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                url text PRIMARY KEY,
+                fetched real,
+                etag text,
+                last_modified text
+                );
+            CREATE TABLE IF NOT EXISTS resources (
+                name text PRIMARY KEY,
+                position integer,
+                description text
+                );
+            CREATE TABLE IF NOT EXISTS files (
+                path text,
+                position integer,
+                url text,
+                PRIMARY KEY (path, position)
+                ) WITHOUT ROWID;
+            """)
+
+    def _refresh(self, url: str, compile_function) -> None:
+        """
+        Downloads a catalog and compiles it with compile_function, unless the
+        local copy is recent enough or the catalog has not changed.
+        """
+        self.cursor.execute("SELECT fetched, etag, last_modified FROM sources WHERE url = ?", [url])
+        row = self.cursor.fetchone()
+        if row is not None and time.time() - row[0] < self.ttl:
+            return
+        etag, last_modified = row[1:] if row is not None else (None, None)
+        from .fetch import Fetcher
+        # With a local copy to fall back on, there is no point in waiting
+        # for retries, e.g. when offline
+        fetcher = Fetcher(retries=self.retries if row is None else 0)
+        try:
+            contents, etag, last_modified = fetcher.fetch_if_modified(url, etag, last_modified)
+        except Exception as e:
+            if row is None:
+                logging.error("Could not download the catalog %s [%s]", url, e)
+                logging.error("Maybe your connection is down?")
+                sys.exit(1)
+            logging.warning("Could not update the catalog %s [%s], using the copy from %s",
+                            url, e, datetime.datetime.fromtimestamp(row[0]).strftime("%Y-%m-%d"))
+            return
+        if contents is not None:
+            compile_function(contents.decode("utf-8"))
+        self.cursor.execute("INSERT OR REPLACE INTO sources(url, fetched, etag, last_modified) VALUES (?,?,?,?)",
+                            [url, time.time(), etag, last_modified])
+        self.connection.commit()
+
+    def _compile_list(self, text: str) -> None:
+        self.cursor.execute("DELETE FROM resources")
+        resources = []
+        for line in text.split("\n"):
+            if line.strip():
+                name, description = (line.strip().split(None, 1) + [""])[:2]
+                resources.append((name, len(resources), description))
+        self.cursor.executemany("INSERT OR REPLACE INTO resources(name, position, description) VALUES (?,?,?)",
+                                resources)
+
+    def _compile_resource(self, name: str, text: str) -> None:
+        import yaml
+        # The C parser is much faster for the large catalogs, if available
+        tree = yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        files = []
+        def walk(node, path):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    # Some keys are integers (years)
+                    walk(value, path + str(key) + "/")
+            elif isinstance(node, list):
+                for url in node:
+                    files.append((path, len(files), url))
+            elif node is not None:
+                files.append((path, len(files), node))
+        walk(tree, name + "/")
+        self.cursor.execute("DELETE FROM files WHERE path >= ? AND path < ?", [name + "/", name + "/\U0010ffff"])
+        self.cursor.executemany("INSERT INTO files(path, position, url) VALUES (?,?,?)", files)
+
+    def resources(self) -> List[tuple]:
+        """Returns the known collections, as (name, description) tuples."""
+        self._refresh(self.database_url + "list.txt", self._compile_list)
+        self.cursor.execute("SELECT name, description FROM resources ORDER BY position")
+        return self.cursor.fetchall()
+
+    def _prefix(self, path: List[str]) -> str:
+        self._refresh(self.database_url + path[0] + ".yml",
+                      lambda text: self._compile_resource(path[0], text))
+        return "".join(component + "/" for component in path)
+
+    def files(self, path: List[str]) -> List[str]:
+        """
+        Returns the URLs of the files under a branch of a collection, in the
+        order of the catalog.
+
+        :param path: The collection, followed by the keys of the branch.
+        """
+        prefix = self._prefix(path)
+        self.cursor.execute("SELECT url FROM files WHERE path >= ? AND path < ? ORDER BY position",
+                            [prefix, prefix + "\U0010ffff"])
+        return [url for url, in self.cursor]
+
+    def children(self, path: List[str]) -> List[tuple]:
+        """
+        Returns the branches right under a branch of a collection, as (key,
+        number of files) tuples in the order of the catalog.
+        """
+        prefix = self._prefix(path)
+        self.cursor.execute("""SELECT path, MIN(position), COUNT(*) FROM files
+                               WHERE path > ? AND path < ? GROUP BY path""",
+                            [prefix, prefix + "\U0010ffff"])
+        children = {}
+        for child_path, position, count in self.cursor:
+            key = child_path[len(prefix):].split("/", 1)[0]
+            first_position, total = children.get(key, (position, 0))
+            children[key] = (min(first_position, position), total + count)
+        return [(key, count) for key, (_, count) in sorted(children.items(), key=lambda item: item[1][0])]
@@ -0,0 +1,111 @@
+"""
+Entry point of the bibsearch command. The commands that a running `bibsearch
+serve` can answer are passed on to it before the rest of bibsearch is
+imported, so that they do not pay for its start-up. Only modules that are
+quick to import may be imported here.
+"""
+
+import json
+import os
+import socket
+import sys
+
+# The commands answered by the server, see bibsearch.SERVED_COMMANDS
+SERVED_COMMANDS = ("find", "search", "key", "tex", "complete")
+
+def request(path, argv, cwd):
+    """
+    Sends a command to a running server.
+
+    :param path: Path of the server socket.
+    :param argv: The command line arguments.
+    :param cwd: The directory the command should run in.
+    :return: A tuple (status, stdout, stderr), or None if no server could
+             answer the request, or the server declined it.
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps({"argv": argv, "cwd": cwd}).encode("utf-8") + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        response = json.loads(data.decode("utf-8"))
+        if response.get("declined"):
+            return None
+        return response["status"], response["stdout"], response["stderr"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _bibsearch_dir(config_file):
+    """
+    Reads bibsearch_dir from a config file without configparser, see
+    config.Config. Returns None for values this does not handle.
+    """
+    bibsearch_dir = os.path.expanduser("~/.bibsearch")
+    section = None
+    try:
+        with open(config_file, encoding="utf-8") as f:
+            for line in f:
+                stripped = line.strip()
+                if not stripped or stripped[0] in "#;" or line[0].isspace():
+                    continue
+                if stripped.startswith("["):
+                    section = stripped[1:].split("]", 1)[0]
+                elif section == "bibsearch":
+                    delimiter = min((stripped.find(d) for d in "=:" if d in stripped), default=-1)
+                    if delimiter >= 0 and stripped[:delimiter].strip().lower() == "bibsearch_dir":
+                        bibsearch_dir = stripped[delimiter + 1:].strip()
+    except (OSError, UnicodeDecodeError):
+        pass
+    # Interpolated values
+    return None if "%" in bibsearch_dir else bibsearch_dir
+
+def _socket_path(argv):
+    """
+    Returns the path of the server socket if argv is a command the server
+    may answer, or None.
+    """
+    config_file = os.path.join(os.path.expanduser("~"), ".bibsearch", "config")
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith("--c"):
+            # --config_file, possibly abbreviated
+            config_file = arg.split("=", 1)[1] if "=" in arg else next(args, None)
+        elif arg.startswith("-c"):
+            config_file = arg[2:] or next(args, None)
+        elif arg.startswith("-"):
+            # --help, --version, or an error
+            return None
+        else:
+            command = arg
+            break
+    else:
+        return None
+    if config_file is None or command not in SERVED_COMMANDS:
+        return None
+    # Watching would keep the server busy
+    if command == "tex" and any(arg.startswith("--w") or (arg[:1] == "-" and arg[1:2] != "-" and "w" in arg)
+                                for arg in args):
+        return None
+    bibsearch_dir = _bibsearch_dir(config_file)
+    return os.path.join(bibsearch_dir, "bibsearch.sock") if bibsearch_dir is not None else None
+
+def main():
+    path = _socket_path(sys.argv[1:])
+    if path is not None:
+        response = request(path, sys.argv[1:], os.getcwd())
+        if response is not None:
+            status, stdout, stderr = response
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            sys.exit(status)
+    # No server, run the command here
+    from .bibsearch import main as bibsearch_main
+    bibsearch_main()
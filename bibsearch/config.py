@@ -1,7 +1,7 @@
 import configparser
 import logging
 import os
-import platform
+import sys
 import tempfile
 
 class Config():
@@ -9,11 +9,17 @@ class Config():
         "bibsearch" : {
               "bibsearch_dir": os.path.expanduser("~/.bibsearch")
             , "download_dir": os.path.expanduser("~/.bibsearch/papers")
-            , "open_command": "xdg-open" if platform.system() == "Linux" else "open"
+            , "open_command": "xdg-open" if sys.platform.startswith("linux") else "open"
             , "database_url": "https://github.com/mjpost/bibsearch/raw/master/resources/"
             , "custom_key_format": "{surname}{year}{suffix}:{title}"
             , "default_output_format": "txt"
+            , "search_weights": "key=2 custom_key=2 author=5 title=3 venue=1 year=1 abstract=0.5 keywords=1.5"
             , "editor": os.environ.get("EDITOR", "nano")
+            , "download_connections": "8"
+            , "download_connections_per_host": "4"
+            , "download_retries": "3"
+            , "pdftotext_command": "pdftotext"
+            , "catalog_ttl": "24"
         }
         , "macros" : {
               '@acl': 'venue:"Annual Meeting of the Association for Computational Linguistics"'
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+from .client import request
+
+def supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        result = self.server.run_command(request["argv"], request["cwd"])
+        if result is None:
+            self.wfile.write(json.dumps({"declined": True}).encode("utf-8"))
+            return
+        status, stdout, stderr = result
+        self.wfile.write(json.dumps({"status": status,
+                                     "stdout": stdout,
+                                     "stderr": stderr}).encode("utf-8"))
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, path, run_command):
+        self.run_command = run_command
+        super().__init__(path, _RequestHandler)
+
+    def handle_error(self, request, client_address):
+        logging.exception("Error while handling a request")
+
+def serve(path, run_command):
+    """
+    Answers requests on a Unix socket until interrupted. Requests are
+    handled one at a time, so run_command may change process-wide state
+    like the working directory or sys.stdout.
+
+    :param path: Path of the server socket.
+    :param run_command: Function taking the arguments and the working
+                        directory of a request, and returning a tuple
+                        (status, stdout, stderr), or None to have the client
+                        run the command itself.
+    """
+    if os.path.exists(path):
+        if request(path, ["--version"], os.getcwd()) is not None:
+            raise RuntimeError("A server is already running at %s" % path)
+        # Left over by a server that did not shut down cleanly
+        os.remove(path)
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(path, run_command)
+    finally:
+        os.umask(old_umask)
+    # Shut down cleanly when killed, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        logging.info("Serving requests on %s", path)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
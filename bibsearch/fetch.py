@@ -0,0 +1,170 @@
+import contextlib
+import http.client
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+class Fetcher:
+    """
+    Thread-safe helper for downloading many URLs concurrently.
+
+    The number of simultaneous connections is limited globally and per host,
+    and failed requests (connection errors, timeouts, HTTP 429 and 5xx) are
+    retried with exponential backoff. The fetcher does not own any threads:
+    callers run it from their own thread pool, and the limits make sure
+    that the servers are not hammered no matter how many threads there are.
+    """
+
+    def __init__(self,
+                 max_connections: int = 8,
+                 max_connections_per_host: int = 4,
+                 retries: int = 3,
+                 backoff: float = 1.0,
+                 timeout: float = 60):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_connections=int(config.download_connections),
+                   max_connections_per_host=int(config.download_connections_per_host),
+                   retries=int(config.download_retries))
+
+    def _host_slots(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._hosts[host]
+
+    def _should_retry(self, error):
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code == 429 or error.code >= 500
+        if isinstance(error, urllib.error.URLError):
+            # Certificate problems will not go away by retrying
+            return not isinstance(error.reason, ssl.SSLError)
+        return isinstance(error, (socket.timeout, ConnectionError, http.client.IncompleteRead))
+
+    def _with_retries(self, url, function):
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except Exception as e:
+                if attempt >= self.retries or not self._should_retry(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.debug('Error fetching "%s" (%s), retrying in %.1fs', url, e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        """
+        Opens a URL, retrying if needed. The connection slots are held until
+        the block exits, so the response should be consumed inside it.
+
+        :param url: The URL to open.
+        :param headers: Additional request headers.
+        :return: The response object, as returned by urllib.
+        """
+        request = urllib.request.Request(url, headers=headers or {})
+        with self._connections, self._host_slots(url):
+            response = self._with_retries(url, lambda: urllib.request.urlopen(request, timeout=self.timeout))
+            with response:
+                yield response
+
+    def fetch(self, url, headers=None) -> bytes:
+        """
+        Downloads the contents of a URL, retrying if needed.
+        """
+        request = urllib.request.Request(url, headers=headers or {})
+        def download():
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        with self._connections, self._host_slots(url):
+            return self._with_retries(url, download)
+
+    def fetch_if_modified(self, url, etag=None, last_modified=None):
+        """
+        Downloads the contents of a URL with a conditional request, using the
+        validators returned by a previous download.
+
+        :return: A tuple (contents, etag, last_modified). The contents are
+                 None if the server reports that the resource is unchanged.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        request = urllib.request.Request(url, headers=headers)
+        def download():
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return (response.read(),
+                            response.headers.get("ETag"),
+                            response.headers.get("Last-Modified"))
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return None, etag, last_modified
+                raise
+        with self._connections, self._host_slots(url):
+            return self._with_retries(url, download)
+
+    def download(self, url, fname, progress=None, chunk_size=65536) -> str:
+        """
+        Downloads a URL to a file, retrying if needed. The data is streamed to
+        fname + ".part", which is only renamed to fname once complete. An
+        interrupted download is resumed from the .part file with a Range
+        request, if the server supports them.
+
+        :param progress: Function called with the size of each chunk received.
+        :return: fname.
+        """
+        part_fname = fname + ".part"
+        def download(offset=None):
+            if offset is None:
+                offset = os.path.getsize(part_fname) if os.path.exists(part_fname) else 0
+            request = urllib.request.Request(url, headers={"Range": "bytes=%d-" % offset} if offset else {})
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 416 and offset:
+                    # The .part file does not match the file on the server
+                    return download(0)
+                raise
+            with response:
+                if response.status != 206:
+                    # Range not supported, starting over
+                    offset = 0
+                length = response.headers.get("Content-Length")
+                with open(part_fname, "ab" if offset else "wb") as fp:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        fp.write(chunk)
+                        if progress is not None:
+                            progress(len(chunk))
+                    size = fp.tell()
+            if length is not None and size != offset + int(length):
+                raise ConnectionError("Connection closed after %d of %d bytes" % (size, offset + int(length)))
+            os.replace(part_fname, fname)
+            return fname
+        directory = os.path.dirname(fname)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connections, self._host_slots(url):
+            return self._with_retries(url, download)
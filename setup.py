@@ -79,14 +79,16 @@ setup(
     # dependencies). You can install these using the following syntax,
     # for example:
     # $ pip install -e .[dev,test]
-    extras_require = {},
+    extras_require = {
+        'watch': ['inotify_simple'],
+    },
 
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'bibsearch = bibsearch.bibsearch:main',
+            'bibsearch = bibsearch.client:main',
         ],
     },
 
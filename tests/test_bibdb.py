@@ -0,0 +1,192 @@
+import os
+import sqlite3
+
+import pytest
+
+from bibsearch import bibsearch, bibutils
+from bibsearch.bibdb import BibDB
+from bibsearch.config import Config
+
+ENTRY = """@inproceedings{Smith2019,
+  title = {Low-Resource Machine Translation},
+  author = {Smith, Ann and M{\\"u}ller, Bob},
+  booktitle = {Proceedings of the Workshop},
+  year = {2019},
+  abstract = {We study parsing of morphologically rich languages.},
+  keywords = {translation, morphology}
+}
+"""
+
+
+def _create_db_without_fts(self):
+    """The tables created by BibDB._create_db when sqlite lacks FTS5."""
+    self.cursor.execute("""CREATE TABLE bib (
+        key text UNIQUE,
+        custom_key text UNIQUE,
+        author text,
+        title text,
+        venue text,
+        year text,
+        fulltext text
+        )""")
+    self.cursor.execute("CREATE TABLE downloaded_files (file text UNIQUE)")
+
+
+@pytest.fixture(params=["fts", "no_fts"])
+def config(request, tmp_path, monkeypatch):
+    if request.param == "no_fts":
+        monkeypatch.setattr(BibDB, "_create_db", _create_db_without_fts)
+    config = Config(os.path.join(str(tmp_path), "config"))
+    config.bibsearch_dir = str(tmp_path)
+    return config
+
+
+def test_open_add_find(config):
+    db = BibDB(config)
+    assert db.add(bibutils.fulltext_to_single_entry(ENTRY))[0]
+    db.save()
+
+    db = BibDB(config)
+    assert len(db) == 1
+    for query in [["translation"], ["author:muller"], ["abstract:morphologically"],
+                  ["keywords:morphology"], ["key:smith2019"], ['title:"machine translation"']]:
+        assert [entry.key for entry in db.search(query)] == ["Smith2019"], query
+    assert db.search(["title:morphology"]) == []
+
+
+def test_interrupted_upgrade(config, monkeypatch):
+    upgrade = BibDB._UPGRADES[-2]
+    original = getattr(BibDB, upgrade)
+
+    def interrupted(self):
+        original(self)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(BibDB, upgrade, interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        BibDB(config)
+    monkeypatch.setattr(BibDB, upgrade, original)
+
+    db = BibDB(config)
+    db.cursor.execute("PRAGMA user_version")
+    assert db.cursor.fetchone()[0] == len(BibDB._UPGRADES)
+    assert db.add(bibutils.fulltext_to_single_entry(ENTRY))[0]
+    assert [entry.key for entry in db.search(["translation"])] == ["Smith2019"]
+
+
+def test_fuzzy_misspelled_words(config):
+    db = BibDB(config)
+    db.add(bibutils.fulltext_to_single_entry(ENTRY))
+    query = ["machne", "translaton", "author:smitt"]
+    assert [entry.key for entry in db.search(query, fuzzy=True)] == ["Smith2019"]
+    # Misspelled words are replaced, correct ones kept
+    assert db._fuzzy_queries(query) == [["machine", "translation", "author:smith"]]
+    assert db._fuzzy_queries(["machine"])[0] == ["machine"]
+
+    # The rowid of the removed entry is reused
+    db.remove("Smith2019")
+    db.add(bibutils.fulltext_to_single_entry(ENTRY.replace("Low-Resource Machine Translation",
+                                                           "Zebrafish Phylogenetics")))
+    assert [entry.key for entry in db.search(["phylogenetcs"], fuzzy=True)] == ["Smith2019"]
+
+
+def test_search_many_keys(config):
+    db = BibDB(config)
+    db.add(bibutils.fulltext_to_single_entry(ENTRY))
+    # The default limit of SQLite before 3.32
+    db.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    keys = ["Missing%d" % i for i in range(600)] + ["Smith2019"]
+    assert list(db.search_keys(keys)) == ["Smith2019"]
+
+
+def test_search_cache_reused_rowid(config):
+    db = BibDB(config)
+    db.add(bibutils.fulltext_to_single_entry(ENTRY))
+    assert [entry.key for entry in db.search(["translation"])] == ["Smith2019"]
+    assert db.get_search_cache_entry(1).key == "Smith2019"
+
+    # The new entry reuses the rowid of the removed one
+    db.remove("Smith2019")
+    db.add(bibutils.fulltext_to_single_entry(ENTRY.replace("Smith2019", "Jones2020")))
+    assert db.get_search_cache_entry(1) is None
+    assert db.search([]) == []
+
+
+def _custom_keys(db):
+    db.cursor.execute("SELECT custom_key FROM bib ORDER BY rowid")
+    return [custom_key for custom_key, in db.cursor]
+
+
+def test_custom_key_suffixes(config, tmp_path):
+    entries = [bibutils.fulltext_to_single_entry(ENTRY.replace("Smith2019", "Smith2019-%d" % i))
+               for i in range(30)]
+    db = BibDB(config)
+    for entry in entries:
+        db.add(entry)
+    # After 'z' come two letter suffixes
+    assert _custom_keys(db) == (["smith2019:low-resource"]
+                                + ["smith2019%s:low-resource" % chr(c) for c in range(ord("a"), ord("z") + 1)]
+                                + ["smith2019aa:low-resource", "smith2019ab:low-resource", "smith2019ac:low-resource"])
+
+    # A bulk import, continuing from entries added before it, allocates the same keys
+    bulk_config = Config(os.path.join(str(tmp_path), "config"))
+    bulk_config.bibsearch_dir = str(tmp_path / "bulk")
+    os.mkdir(bulk_config.bibsearch_dir)
+    bulk_db = BibDB(bulk_config)
+    for entry in entries[:3]:
+        bulk_db.add(entry)
+    with bulk_db.bulk_import(batch_size=7):
+        for entry in entries[3:]:
+            bulk_db.add(entry)
+    assert _custom_keys(bulk_db) == _custom_keys(db)
+
+
+def test_custom_key_format_without_suffix(config):
+    config.custom_key_format = "{surname}{year}"
+    db = BibDB(config)
+    for i in range(3):
+        db.add(bibutils.fulltext_to_single_entry(ENTRY.replace("Smith2019", "Smith2019-%d" % i)))
+    # The suffix goes at the end
+    assert _custom_keys(db) == ["smith2019", "smith2019a", "smith2019b"]
+    assert [entry.key for entry in db.search(["key:smith2019a"])] == ["Smith2019-1"]
+
+
+def _rendered(db):
+    db.cursor.execute("SELECT entry, format, text FROM rendered ORDER BY entry, format")
+    return db.cursor.fetchall()
+
+
+def test_rendered_cache_invalidation(config):
+    db = BibDB(config)
+    db.add(bibutils.fulltext_to_single_entry(ENTRY))
+    text = bibsearch.format_search_results(db.search(["translation"]), "bib", db=db)
+    assert "@inproceedings{smith2019:low-resource," in text
+    assert [entry for entry, _, _ in _rendered(db)] == [1]
+    assert bibsearch.format_search_results(db.search(["translation"]), "bib", db=db) == text
+    assert db.get_stat("render_cache_hits") == 1
+
+    # Updating an entry drops its renderings
+    db.update_custom_key("Smith2019", "smith:new")
+    assert _rendered(db) == []
+    assert "@inproceedings{smith:new," in bibsearch.format_search_results(db.search(["translation"]), "bib", db=db)
+
+    db.remove("Smith2019")
+    assert _rendered(db) == []
+
+
+def test_rendered_cache_txt_index(config):
+    db = BibDB(config)
+    for i in range(12):
+        db.add(bibutils.fulltext_to_single_entry(ENTRY.replace("Smith2019", "Smith2019-%d" % i)))
+    text = bibsearch.format_search_results(db.search(["translation"]), "txt", db=db)
+    # The renderings are cached with a placeholder for the index, whose width
+    # is part of the format
+    assert sorted(set((output_format, text[:text.index(".")]) for _, output_format, text in _rendered(db))) == [
+        ("txt:1", "#"), ("txt:2", "##")]
+
+    cached_text = bibsearch.format_search_results(db.search(["translation"]), "txt", db=db)
+    assert db.get_stat("render_cache_hits") == 12
+    assert cached_text == text
+    assert "#" not in cached_text
+    assert [line.split(".")[0] for line in cached_text.split("\n") if line and not line.startswith(" ")] \
+        == [str(i) for i in range(1, 13)]
@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+from bibsearch import bibsearch
+
+
+def test_scan_tex(tmp_path):
+    (tmp_path / "main.tex").write_text(r"""
+\documentclass{article}
+\begin{document}
+\Citet{a} \Citep[see][p.~2]{b} \Cites{c}{d, e}
+% \cite{commented}
+50\% of \citealt*{f}
+\input{chapter}
+\Citeauthor{a} \Cite{g}
+\citestyle{nature} \defcitealias{a}{Paper~I} \citetalias{a} \citeindextrue
+\bibliography{refs.bib}
+\end{document}
+""")
+    (tmp_path / "chapter.tex").write_text(r"\cites[1]{h}[2]{i} \nocite{*}")
+    keys, bibdata, fnames = bibsearch._scan_tex(str(tmp_path / "main.tex"))
+    assert keys == ["a", "b", "c", "d", "e", "f", "h", "i", "g"]
+    assert bibdata == "refs"
+    assert fnames == [str(tmp_path / "main.tex"), os.path.join(str(tmp_path), "chapter.tex")]
+
+
+def test_serve_failed_command_releases_lock(tmp_path, monkeypatch):
+    config_file = str(tmp_path / "config")
+    with open(config_file, "w") as f:
+        f.write("[bibsearch]\nbibsearch_dir = %s\n" % tmp_path)
+    served = []
+    monkeypatch.setattr(bibsearch.daemon, "serve", lambda path, run_command: served.append(run_command))
+    bibsearch._get_db.cache_clear()
+    args = bibsearch.get_parser().parse_args(["-c", config_file, "serve"])
+    bibsearch._serve(args, bibsearch.Config(config_file))
+
+    # An unterminated FTS string fails after the search cache was cleared
+    status, stdout, stderr = served[0](["-c", config_file, "find", '"foo'], str(tmp_path))
+    assert status == 1
+
+    connection = sqlite3.connect(str(tmp_path / "bib.db"), timeout=0)
+    connection.execute("BEGIN IMMEDIATE")
+    connection.rollback()
+    connection.close()
+    bibsearch._get_db.cache_clear()
+
+
+def test_sync_unchanged_file(tmp_path, servers, capsys, monkeypatch):
+    config_file = str(tmp_path / "config")
+    with open(config_file, "w") as f:
+        f.write("[bibsearch]\nbibsearch_dir = %s\n" % tmp_path)
+    contents = {"bib": b"@misc{a, title = {First}}\n@misc{b, title = {Second}}\n"}
+    # Ignores the conditional headers, sending the file again
+    server = servers(lambda handler: handler.reply(200, contents["bib"], {"ETag": '"v1"'}))
+    parsed = []
+    parse_stream = bibsearch._parse_stream
+    monkeypatch.setattr(bibsearch, "_parse_stream",
+                        lambda fname, stream: parsed.append(fname) or parse_stream(fname, stream))
+
+    def run(*argv):
+        args = bibsearch.get_parser().parse_args(["-c", config_file] + list(argv))
+        args.func(args, bibsearch.Config(config_file))
+        return capsys.readouterr().out
+
+    assert "Added 2 entries" in run("add", server.url)
+    assert "Added 0 entries, skipped 0 duplicates. Skipped 1 files" in run("sync", server.url)
+    assert parsed == [server.url]
+
+    contents["bib"] += b"@misc{c, title = {Third}}\n"
+    assert "Added 1 entries, skipped 2 duplicates" in run("sync", server.url)
+    assert len(parsed) == 2
@@ -0,0 +1,37 @@
+import io
+
+import pybtex.database
+import pytest
+
+from bibsearch import bibutils
+
+BIBTEX = """Text between entries is ignored, even with ) and "quotes".
+
+@string{anlp = "Applied NLP {(ANLP)}"}
+@string(acl = "ACL (2000)")
+
+@article{a,
+  title = {Braces {(and} parentheses)},
+  journal = anlp,
+  year = 2000
+}
+
+@article(b, title = "P (Q) R", year=2001)
+
+@inproceedings(c,
+  title = "Quotes {"inside"} braces",
+  booktitle = acl # " Workshop",
+  year = {2002}
+)
+"""
+
+
+def _fields(entries):
+    return [(entry.key, dict(entry.fields)) for entry in entries]
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7, 16, 65536])
+def test_iter_bibtex_entries(block_size):
+    expected = _fields(pybtex.database.parse_string(BIBTEX, "bibtex").entries.values())
+    assert [key for key, _ in expected] == ["a", "b", "c"]
+    assert _fields(bibutils.iter_bibtex_entries(io.StringIO(BIBTEX), block_size)) == expected
@@ -0,0 +1,17 @@
+import os
+
+from bibsearch import client
+
+
+def test_socket_path(tmp_path):
+    config_file = str(tmp_path / "config")
+    with open(config_file, "w") as f:
+        f.write("[macros]\nbibsearch_dir = elsewhere\n\n[bibsearch]\n# A comment\nBibsearch_Dir: %s\n" % tmp_path)
+    socket_path = os.path.join(str(tmp_path), "bibsearch.sock")
+    for argv in [["-c", config_file, "find", "a"], ["-c" + config_file, "search"],
+                 ["--config=" + config_file, "tex", "-b", "paper.tex"], ["--config_file", config_file, "key", "a"]]:
+        assert client._socket_path(argv) == socket_path, argv
+    # Commands not answered by the server
+    for argv in [["-c", config_file, "add", "a.bib"], ["-c", config_file, "tex", "-bw", "paper.tex"],
+                 ["-c", config_file, "tex", "--watch", "paper.tex"], ["-c", config_file, "--version"], []]:
+        assert client._socket_path(argv) is None, argv
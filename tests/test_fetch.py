@@ -0,0 +1,143 @@
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from bibsearch.fetch import Fetcher
+
+DATA = bytes(range(256)) * 64
+
+
+class Concurrency:
+    """Counts the requests being answered, overall and per server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_total = 0
+        self.max_per_server = 0
+
+    def respond(self, handler):
+        port = handler.server.server_address[1]
+        with self.lock:
+            self.active[port] = self.active.get(port, 0) + 1
+            self.max_total = max(self.max_total, sum(self.active.values()))
+            self.max_per_server = max(self.max_per_server, self.active[port])
+        time.sleep(0.1)
+        with self.lock:
+            self.active[port] -= 1
+        handler.reply(200, b"ok")
+
+
+def fetch_all(fetcher, urls):
+    threads = [threading.Thread(target=fetcher.fetch, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_connections_per_host(servers):
+    concurrency = Concurrency()
+    server = servers(concurrency.respond)
+    fetch_all(Fetcher(max_connections=8, max_connections_per_host=2), [server.url] * 6)
+    assert len(server.requests) == 6
+    assert concurrency.max_per_server == 2
+
+
+def test_connections_overall(servers):
+    concurrency = Concurrency()
+    first, second = servers(concurrency.respond), servers(concurrency.respond)
+    fetch_all(Fetcher(max_connections=3, max_connections_per_host=4), [first.url, second.url] * 4)
+    assert len(first.requests) + len(second.requests) == 8
+    assert concurrency.max_total == 3
+
+
+def test_retry_server_errors(servers):
+    def respond(handler):
+        if len(server.requests) <= 2:
+            handler.reply(503)
+        else:
+            handler.reply(200, DATA)
+    server = servers(respond)
+    start = time.time()
+    assert Fetcher(retries=3, backoff=0.1).fetch(server.url) == DATA
+    assert len(server.requests) == 3
+    # Waits 0.1s, then 0.2s
+    assert time.time() - start >= 0.3
+
+    del server.requests[:]
+    with pytest.raises(urllib.error.HTTPError) as e:
+        Fetcher(retries=1, backoff=0.01).fetch(server.url)
+    assert e.value.code == 503
+    assert len(server.requests) == 2
+
+
+def test_no_retry_client_errors(servers):
+    server = servers(lambda handler: handler.reply(404))
+    with pytest.raises(urllib.error.HTTPError):
+        Fetcher(retries=3, backoff=0.01).fetch(server.url)
+    assert len(server.requests) == 1
+
+
+def test_fetch_if_modified(servers):
+    validators = {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    def respond(handler):
+        if handler.headers.get("If-None-Match") == validators["ETag"]:
+            handler.reply(304)
+        else:
+            handler.reply(200, DATA, validators)
+    server = servers(respond)
+    fetcher = Fetcher()
+    assert fetcher.fetch_if_modified(server.url) == (DATA, validators["ETag"], validators["Last-Modified"])
+    assert fetcher.fetch_if_modified(server.url, *validators.values()) \
+        == (None, validators["ETag"], validators["Last-Modified"])
+    assert server.requests[-1]["If-Modified-Since"] == validators["Last-Modified"]
+    assert fetcher.fetch_if_modified(server.url, '"v0"') == (DATA, validators["ETag"], validators["Last-Modified"])
+
+
+def respond_with_ranges(handler):
+    range_header = handler.headers.get("Range")
+    if range_header is None:
+        handler.reply(200, DATA)
+        return
+    start = int(range_header[len("bytes="):-1])
+    if start >= len(DATA):
+        handler.reply(416)
+    else:
+        handler.reply(206, DATA[start:],
+                      {"Content-Range": "bytes %d-%d/%d" % (start, len(DATA) - 1, len(DATA))})
+
+
+def test_download_resumes_part_file(servers, tmp_path):
+    server = servers(respond_with_ranges)
+    fname = str(tmp_path / "paper.pdf")
+    with open(fname + ".part", "wb") as fp:
+        fp.write(DATA[:1000])
+    assert Fetcher().download(server.url, fname) == fname
+    assert server.requests[0]["Range"] == "bytes=1000-"
+    with open(fname, "rb") as fp:
+        assert fp.read() == DATA
+    assert not (tmp_path / "paper.pdf.part").exists()
+
+
+def test_download_restarts_without_ranges(servers, tmp_path):
+    server = servers(lambda handler: handler.reply(200, DATA))
+    fname = str(tmp_path / "paper.pdf")
+    with open(fname + ".part", "wb") as fp:
+        fp.write(b"stale")
+    Fetcher().download(server.url, fname)
+    with open(fname, "rb") as fp:
+        assert fp.read() == DATA
+
+
+def test_download_restarts_mismatched_part_file(servers, tmp_path):
+    server = servers(respond_with_ranges)
+    fname = str(tmp_path / "paper.pdf")
+    with open(fname + ".part", "wb") as fp:
+        fp.write(DATA + b"longer")
+    Fetcher().download(server.url, fname)
+    assert [request.get("Range") for request in server.requests] == ["bytes=%d-" % (len(DATA) + 6), None]
+    with open(fname, "rb") as fp:
+        assert fp.read() == DATA